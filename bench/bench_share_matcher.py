@@ -0,0 +1,110 @@
+"""
+micro-benchmark for classifying torrents into shareLimits groups
+compares the compiled ShareMatcher with the per-group scan it replaced
+
+usage: python -m bench.bench_share_matcher [-groups 100] [-torrents 10000]
+"""
+
+import argparse
+import random
+import string
+import time
+
+from utils.config import ShareGroup
+from utils.share_matcher import ShareMatcher
+
+LIMITS = {
+    "priorityInQueue": True,
+    "ratio_limit": 2,
+    "seeding_time_limit": 1440,
+    "upload_speed_limit": -1,
+    "tags": "",
+}
+
+
+def make_share_limits(group_count, terms_per_group, categories_per_group, rng):
+    share_limits = {}
+    for i in range(group_count):
+        share_limits[f"group{i}"] = {
+            "trackers": [
+                f"{''.join(rng.choices(string.ascii_lowercase, k=8))}-tracker{i}.org"
+                for _ in range(terms_per_group)
+            ],
+            "categories": [f"Category {i}-{j}" for j in range(categories_per_group)],
+            **LIMITS,
+        }
+    share_limits["default"] = {"trackers": [], "categories": [], **LIMITS}
+    return share_limits
+
+
+def make_torrents(share_limits, torrent_count, rng):
+    terms = [term for val in share_limits.values() for term in val["trackers"]]
+    categories = [cat for val in share_limits.values() for cat in val["categories"]]
+    torrents = []
+    for i in range(torrent_count):
+        if rng.random() < 0.5:
+            host = rng.choice(terms).upper()
+        else:
+            host = f"open-{i}.example.net"
+        urls = [
+            f"https://{host}/announce?passkey={i:032x}",
+            "udp://tracker.example.com:1337",
+        ]
+        category = rng.choice(categories) if rng.random() < 0.5 else "uncategorized"
+        torrents.append((" ".join(urls), category))
+    return torrents
+
+
+def scan_groups(share_limits, urls, category):
+    """classification as ShareLimiter did it before the matcher was compiled"""
+    for key, val in share_limits.items():
+        if any(term.lower() in urls.lower() for term in val["trackers"]):
+            return key
+    for key, val in share_limits.items():
+        if category in val["categories"]:
+            return key
+    return False
+
+
+def compiled(matcher, urls, category):
+    return matcher.match_trackers(urls) or matcher.match_category(category)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark share limit matching")
+    parser.add_argument("-groups", type=int, default=100)
+    parser.add_argument("-terms", type=int, default=3, help="tracker terms per group")
+    parser.add_argument("-torrents", type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    share_limits = make_share_limits(args.groups, args.terms, 2, rng)
+    torrents = make_torrents(share_limits, args.torrents, rng)
+
+    share_groups = {
+        name: ShareGroup.from_config(name, val) for name, val in share_limits.items()
+    }
+    matcher, compile_seconds = timed(ShareMatcher, share_groups)
+    old, old_seconds = timed(
+        lambda: [scan_groups(share_limits, u, c) for u, c in torrents]
+    )
+    new, new_seconds = timed(lambda: [compiled(matcher, u, c) for u, c in torrents])
+    if old != new:
+        raise SystemExit("compiled matcher disagrees with the group scan")
+
+    print(f"{args.groups} groups x {args.terms} terms, {args.torrents} torrents")
+    print(f"group scan:       {old_seconds * 1000:9.1f} ms")
+    print(
+        f"compiled matcher: {new_seconds * 1000:9.1f} ms (+{compile_seconds * 1000:.1f} ms compile)"
+    )
+    print(f"speedup:          {old_seconds / new_seconds:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
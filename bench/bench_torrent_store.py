@@ -0,0 +1,161 @@
+"""
+micro-benchmark for the torrent store on a large instance
+compares TorrentRecord storage with the whole-dict storage and TorrentDictionary listings it replaced, each in its
+own process so peak RSS is measured separately: memory kept, full sync, a 1% delta sync, and one tick of listings
+
+usage: python -m bench.bench_torrent_store [-torrents 100000]
+"""
+
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from qbittorrentapi import TorrentDictionary
+
+from bench.fake_qbittorrent import FakeQbittorrent
+from bench.synthetic import make_config, populate
+from utils.torrent_store import STATUS_FILTERS, TorrentStore
+
+# fields qbittorrent sends for every torrent that the fake leaves out
+EXTRA_FIELDS = {
+    "amount_left": 0,
+    "auto_tmm": False,
+    "availability": -1,
+    "completed": 0,
+    "dl_limit": -1,
+    "downloaded": 0,
+    "downloaded_session": 0,
+    "eta": 8640000,
+    "f_l_piece_prio": False,
+    "force_start": False,
+    "last_activity": 0,
+    "magnet_uri": "magnet:?xt=urn:btih:",
+    "max_ratio": -1,
+    "max_seeding_time": -1,
+    "num_seeds": 0,
+    "seen_complete": 0,
+    "seq_dl": False,
+    "super_seeding": False,
+    "time_active": 0,
+    "total_size": 0,
+    "uploaded": 0,
+    "uploaded_session": 0,
+    "infohash_v1": "",
+    "infohash_v2": "",
+}
+
+
+class DictStore(TorrentStore):
+    """the store as it was: whole torrent dicts, listed as TorrentDictionary copies"""
+
+    def sync(self):
+        with self._lock:
+            maindata = self.qbitclient.sync_maindata(rid=self.rid)
+            self.generation += 1
+            for hash_, fields in maindata.get("torrents", {}).items():
+                self.torrents.setdefault(hash_, {"hash": hash_}).update(fields)
+                self.changed[hash_] = self.generation
+            self.rid = maindata["rid"]
+
+    def torrents_info(self, status_filter=None, torrent_hashes=None):
+        states = STATUS_FILTERS[status_filter] if status_filter else None
+        with self._lock:
+            if torrent_hashes is None:
+                torrents = self.torrents.values()
+            else:
+                torrents = [
+                    self.torrents[i] for i in torrent_hashes if i in self.torrents
+                ]
+            return [
+                TorrentDictionary(dict(torrent), client=self.qbitclient)
+                for torrent in torrents
+                if states is None or torrent.get("state") in states
+            ]
+
+
+class MaindataClient:
+    """serves prepared sync/maindata responses in order, without HTTP, so only the store is timed"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+
+    def sync_maindata(self, rid=0):
+        return self.responses.pop(0)
+
+
+def make_responses(torrent_count):
+    """a full sync/maindata response and a delta changing 1% of torrents"""
+    with tempfile.TemporaryDirectory() as root:
+        fake = FakeQbittorrent()
+        populate(fake, make_config(root, 20), torrent_count, 0, 0)
+    full = fake.maindata({})
+    for fields in full["torrents"].values():
+        fields.update(EXTRA_FIELDS)
+    delta = {
+        "rid": full["rid"] + 1,
+        "torrents": {
+            hash_: {"upspeed": 1024, "num_leechs": 1, "ratio": 1.5}
+            for hash_ in list(full["torrents"])[:: max(1, 100)]
+        },
+    }
+    return full, delta
+
+
+def tick(store):
+    """the listings one round of limits, cleaner and plex tasks makes"""
+    store.torrents_info(status_filter="downloading")
+    completed = store.torrents_info(status_filter="completed")
+    seeding = {i.hash for i in store.torrents_info(status_filter="seeding")}
+    return [i for i in completed if i.hash not in seeding and "Processed" not in i.tags]
+
+
+def measure(store_name, torrent_count):
+    full, delta = make_responses(torrent_count)
+    store_class = DictStore if store_name == "dict" else TorrentStore
+    start = time.perf_counter()
+    store_class(MaindataClient([full])).sync()
+    full_sync = time.perf_counter() - start
+    # synced again under tracemalloc, which slows allocation too much to time with it on
+    store = store_class(MaindataClient([full, delta]))
+    tracemalloc.start()
+    store.sync()
+    kept = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del full
+    start = time.perf_counter()
+    store.sync()
+    delta_sync = time.perf_counter() - start
+    start = time.perf_counter()
+    tick(store)
+    tick_seconds = time.perf_counter() - start
+    return {
+        "kept MB": kept / 2**20,
+        "full sync s": full_sync,
+        "delta sync s": delta_sync,
+        "tick s": tick_seconds,
+        "peak RSS MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark torrent store memory")
+    parser.add_argument("-torrents", type=int, default=100000)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for store_name in ("dict", "record"):
+        with context.Pool(1) as pool:
+            results[store_name] = pool.apply(measure, (store_name, args.torrents))
+
+    print(f"{args.torrents} torrents")
+    print(f"{'':<14}{'dicts':>10}{'records':>10}")
+    for key in results["dict"]:
+        print(f"{key:<14}{results['dict'][key]:>10.2f}{results['record'][key]:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""
+local stand-in for the qBittorrent WebAPI v2, serving an in-memory torrent table over http
+covers the endpoints qbitmgr uses and counts every request by endpoint so benchmarks can report API calls
+"""
+
+import hashlib
+import json
+import os
+import secrets
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlsplit
+
+from utils.torrent_store import STATUS_FILTERS
+
+# entries qbittorrent lists before a torrent's real trackers
+PSEUDO_TRACKERS = ["** [DHT] **", "** [PeX] **", "** [LSD] **"]
+
+
+class FakeQbittorrent:
+    """
+    in-memory qbittorrent: torrents, trackers, files, categories, tags and rss rules.
+    every change bumps the sync rid so sync/maindata can send deltas like the real client does
+    """
+
+    def __init__(self, piece_size=65536, latency=0):
+        self.piece_size = piece_size
+        self.latency = latency  # seconds added to every request, as over a network
+        self.torrents = {}  # hash -> torrent fields as listed by torrents/info
+        self.trackers = {}  # hash -> list of tracker urls
+        self.files = {}  # hash -> list of (name relative to save path, size)
+        self.categories = {}
+        self.tags = set()
+        self.rules = {}
+        self.calls = Counter()
+        self.rid = 0
+        self.modified = {}  # hash -> rid of the last change
+        self.removed = {}  # hash -> rid of the removal
+        self.categories_rid = 0
+        self.tags_rid = 0
+        self._lock = Lock()
+        self._sessions = set()
+        self._server = None
+        self.routes = {
+            "auth/login": self.login,
+            "app/version": lambda params: "v4.3.8",
+            "app/webapiVersion": lambda params: "2.8.2",
+            "sync/maindata": self.maindata,
+            "transfer/info": self.transfer_info,
+            "torrents/info": self.torrents_info,
+            "torrents/trackers": self.torrent_trackers,
+            "torrents/files": self.torrent_files,
+            "torrents/properties": self.torrent_properties,
+            "torrents/pieceHashes": self.piece_hashes,
+            "torrents/categories": lambda params: self.categories,
+            "torrents/createCategory": self.create_category,
+            "torrents/tags": lambda params: sorted(self.tags),
+            "torrents/addTags": self.add_tags,
+            "torrents/setShareLimits": self.set_share_limits,
+            "torrents/setUploadLimit": self.set_upload_limit,
+            "torrents/topPrio": self.top_priority,
+            "torrents/bottomPrio": self.bottom_priority,
+            "torrents/delete": self.delete,
+            "rss/rules": lambda params: self.rules,
+            "rss/setRule": self.set_rule,
+        }
+
+    def add_torrent(self, fields, trackers, files):
+        """adds a torrent
+        Args:
+            fields: dict of torrents/info fields, including 'hash'
+            trackers: list of tracker urls
+            files: list of (name relative to save path, size)
+        Returns: None
+        """
+        hash_ = fields["hash"]
+        self.torrents[hash_] = fields
+        self.trackers[hash_] = trackers
+        self.files[hash_] = files
+        self.touch(hash_)
+        if fields.get("category"):
+            self.categories.setdefault(
+                fields["category"],
+                {"name": fields["category"], "savePath": fields["save_path"]},
+            )
+        self.tags.update(i.strip() for i in fields["tags"].split(",") if i.strip())
+
+    def touch(self, hash_):
+        self.rid += 1
+        self.modified[hash_] = self.rid
+
+    def selected(self, params):
+        """torrents named by a request's 'hashes' or 'hash' parameter"""
+        hashes = params.get("hashes", params.get("hash", ""))
+        if hashes == "all":
+            return list(self.torrents.values())
+        return [self.torrents[i] for i in hashes.split("|") if i in self.torrents]
+
+    # request handlers, each takes a dict of request parameters
+
+    def login(self, params):
+        sid = secrets.token_hex(16)
+        self._sessions.add(sid)
+        return "Ok.", {"Set-Cookie": f"SID={sid}; HttpOnly; path=/"}
+
+    def maindata(self, params):
+        rid = int(params.get("rid", 0))
+        response = {"rid": self.rid, "server_state": self.transfer_info(params)}
+        if rid <= 0 or rid > self.rid:
+            response["full_update"] = True
+            changed = self.torrents
+            response["categories"] = self.categories
+            response["tags"] = sorted(self.tags)
+        else:
+            changed = [i for i, modified in self.modified.items() if modified > rid]
+            removed = [i for i, removed in self.removed.items() if removed > rid]
+            if removed:
+                response["torrents_removed"] = removed
+            if self.categories_rid > rid:
+                response["categories"] = self.categories
+            if self.tags_rid > rid:
+                response["tags"] = sorted(self.tags)
+        response["torrents"] = {
+            i: {key: val for key, val in self.torrents[i].items() if key != "hash"}
+            for i in changed
+        }
+        return response
+
+    def transfer_info(self, params):
+        return {
+            "up_info_speed": sum(i.get("upspeed", 0) for i in self.torrents.values()),
+            "dl_info_speed": sum(i.get("dlspeed", 0) for i in self.torrents.values()),
+            "up_rate_limit": 0,
+            "dl_rate_limit": 0,
+            "connection_status": "connected",
+        }
+
+    def torrents_info(self, params):
+        if "hashes" in params:
+            torrents = self.selected(params)
+        else:
+            torrents = list(self.torrents.values())
+        states = STATUS_FILTERS.get(params.get("filter"))
+        if states is not None:
+            torrents = [i for i in torrents if i["state"] in states]
+        if "category" in params:
+            torrents = [i for i in torrents if i["category"] == params["category"]]
+        if "sort" in params:
+            torrents.sort(
+                key=lambda i: i.get(params["sort"], 0),
+                reverse=params.get("reverse", "false").lower() == "true",
+            )
+        offset = int(params.get("offset", 0))
+        if offset < 0:
+            offset += len(torrents)
+        limit = int(params.get("limit", 0))
+        return torrents[offset : offset + limit if limit > 0 else None]
+
+    def torrent_trackers(self, params):
+        trackers = [
+            {"url": url, "status": 0, "tier": -1, "msg": ""} for url in PSEUDO_TRACKERS
+        ]
+        trackers.extend(
+            {"url": url, "status": 2, "tier": tier, "msg": ""}
+            for tier, url in enumerate(self.trackers.get(params["hash"], []))
+        )
+        return trackers
+
+    def torrent_files(self, params):
+        files = []
+        offset = 0
+        for index, (name, size) in enumerate(self.files.get(params["hash"], [])):
+            first = offset // self.piece_size
+            last = max(first, (offset + size - 1) // self.piece_size)
+            files.append(
+                {
+                    "index": index,
+                    "name": name,
+                    "size": size,
+                    "progress": 1,
+                    "priority": 1,
+                    "piece_range": [first, last],
+                }
+            )
+            offset += size
+        return files
+
+    def torrent_properties(self, params):
+        torrent = self.torrents[params["hash"]]
+        total_size = sum(size for _, size in self.files[params["hash"]])
+        return {
+            "save_path": torrent["save_path"],
+            "piece_size": self.piece_size,
+            "pieces_num": -(-total_size // self.piece_size),
+            "total_size": total_size,
+        }
+
+    def piece_hashes(self, params):
+        """hashes the torrent's files as they are on disk, or no hashes if any file is missing"""
+        torrent = self.torrents[params["hash"]]
+        sha1 = hashlib.sha1()
+        filled = 0
+        hashes = []
+        for name, size in self.files[params["hash"]]:
+            path = os.path.join(torrent["save_path"], name)
+            if not os.path.isfile(path):
+                return []
+            with open(path, "rb") as file:
+                while True:
+                    chunk = file.read(self.piece_size - filled)
+                    if not chunk:
+                        break
+                    sha1.update(chunk)
+                    filled += len(chunk)
+                    if filled == self.piece_size:
+                        hashes.append(sha1.hexdigest())
+                        sha1 = hashlib.sha1()
+                        filled = 0
+        if filled:
+            hashes.append(sha1.hexdigest())
+        return hashes
+
+    def create_category(self, params):
+        name = params["category"]
+        if name in self.categories:
+            return 409, "Category already exists"
+        self.categories[name] = {"name": name, "savePath": params.get("savePath", "")}
+        self.rid += 1
+        self.categories_rid = self.rid
+
+    def add_tags(self, params):
+        new_tags = [i.strip() for i in params["tags"].split(",") if i.strip()]
+        for torrent in self.selected(params):
+            tags = [i.strip() for i in torrent["tags"].split(",") if i.strip()]
+            tags.extend(i for i in new_tags if i not in tags)
+            torrent["tags"] = ", ".join(sorted(tags))
+            self.touch(torrent["hash"])
+        if not self.tags.issuperset(new_tags):
+            self.tags.update(new_tags)
+            self.rid += 1
+            self.tags_rid = self.rid
+
+    def set_share_limits(self, params):
+        for torrent in self.selected(params):
+            torrent["ratio_limit"] = float(params["ratioLimit"])
+            torrent["seeding_time_limit"] = int(params["seedingTimeLimit"])
+            self.touch(torrent["hash"])
+
+    def set_upload_limit(self, params):
+        for torrent in self.selected(params):
+            torrent["up_limit"] = int(params["limit"])
+            self.touch(torrent["hash"])
+
+    def queued(self):
+        return sorted(
+            (i for i in self.torrents.values() if i.get("priority", 0) > 0),
+            key=lambda i: i["priority"],
+        )
+
+    def renumber(self, queue):
+        for position, torrent in enumerate(queue, 1):
+            if torrent["priority"] != position:
+                torrent["priority"] = position
+                self.touch(torrent["hash"])
+
+    def top_priority(self, params):
+        # like qbittorrent, torrents moved together keep their order in the queue
+        moved = sorted(
+            (i for i in self.selected(params) if i.get("priority", 0) > 0),
+            key=lambda i: i["priority"],
+        )
+        moved_hashes = {i["hash"] for i in moved}
+        self.renumber(
+            moved + [i for i in self.queued() if i["hash"] not in moved_hashes]
+        )
+
+    def bottom_priority(self, params):
+        # like qbittorrent, torrents moved together keep their order in the queue
+        moved = sorted(
+            (i for i in self.selected(params) if i.get("priority", 0) > 0),
+            key=lambda i: i["priority"],
+        )
+        moved_hashes = {i["hash"] for i in moved}
+        self.renumber(
+            [i for i in self.queued() if i["hash"] not in moved_hashes] + moved
+        )
+
+    def delete(self, params):
+        for torrent in self.selected(params):
+            hash_ = torrent["hash"]
+            del self.torrents[hash_]
+            self.modified.pop(hash_, None)
+            self.rid += 1
+            self.removed[hash_] = self.rid
+
+    def set_rule(self, params):
+        self.rules[params["ruleName"]] = json.loads(params["ruleDef"])
+
+    # http server
+
+    def handle(self, endpoint, params, cookies):
+        """runs the handler for an endpoint
+        Returns:
+            tuple of (status, body, extra headers)
+        """
+        route = self.routes.get(endpoint)
+        if route is None:
+            return 404, "Not Found", {}
+        if endpoint != "auth/login" and cookies.get("SID") not in self._sessions:
+            return 403, "Forbidden", {}
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls[endpoint] += 1
+            result = route(params)
+        headers = {}
+        if isinstance(result, tuple) and isinstance(result[1], dict):
+            result, headers = result
+        status = 200
+        if isinstance(result, tuple):
+            status, result = result
+        return status, result, headers
+
+    def start(self, host="127.0.0.1", port=0):
+        """serves the api from a background thread
+        Returns:
+            base url of the api
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def respond(self, params):
+                cookies = dict(
+                    i.strip().split("=", 1)
+                    for i in self.headers.get("Cookie", "").split(";")
+                    if "=" in i
+                )
+                url = urlsplit(self.path)
+                endpoint = url.path[len("/api/v2/") :]
+                params.update(parse_qs(url.query))
+                status, result, headers = fake.handle(
+                    endpoint, {key: val[0] for key, val in params.items()}, cookies
+                )
+                if result is None:
+                    result = ""
+                if isinstance(result, str):
+                    body, content_type = result.encode(), "text/plain; charset=UTF-8"
+                else:
+                    body, content_type = json.dumps(result).encode(), "application/json"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, val in headers.items():
+                    self.send_header(key, val)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond({})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.respond(parse_qs(self.rfile.read(length).decode()))
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, name="fake-qbt", daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
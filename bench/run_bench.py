@@ -0,0 +1,268 @@
+"""
+end to end benchmark of qbitmgr's tasks against a local fake qBittorrent WebAPI
+every case gets a fresh generated torrent table and content tree, then times the task and counts the API requests
+it sends. tick based tasks are timed twice: the first tick sees every torrent, the idle tick only what changed
+
+usage: python -m bench.run_bench [-torrents 5000] [-cases limits,cleaner] [-save] [-baseline bench/baseline.json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+import qbittorrentapi
+import toml
+
+from bench.fake_qbittorrent import FakeQbittorrent
+from bench.synthetic import make_config, populate
+from utils.async_client import make_api
+from utils.add_cat import AddCategory
+from utils.add_rule import RSSRule
+from utils.cleaner import Cleaner
+from utils.config import Config
+from utils.copier import Copier
+from utils.genres import GenreResolver
+from utils.importer import Importer
+from utils.journal import Journal
+from utils.plex_scanner import PlexScanner, ScanCoordinator
+from utils.set_limits import ShareLimiter
+from utils.torrent_store import DEFAULT_PAGE_SIZE, DEFAULT_SORT, TorrentStore
+
+CASES = ["limits", "cleaner", "plex", "copier", "add-rule", "import"]
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+
+
+class World:
+    """a fake qbittorrent with a generated torrent table and content tree, and a client logged in to it"""
+
+    def __init__(self, args, root):
+        self.config = make_config(root, args.groups)
+        for override in args.set:
+            self.config.update(toml.loads(override))
+        self.fake = FakeQbittorrent(latency=args.latency / 1000)
+        populate(self.fake, self.config, args.torrents, args.content, args.file_size)
+        self.config["host"] = self.fake.start()
+        self.config = Config(self.config)
+        self.qbitclient = qbittorrentapi.Client(
+            host=self.config["host"], username="admin", password="adminadmin"
+        )
+        self.qbitclient.app_web_api_version()
+        self.journal = Journal(os.path.join(root, "qbitmgr.db"))
+        self.genre_resolver = GenreResolver(self.config.genres)
+        self.api = make_api(self.config, self.qbitclient)
+
+    def torrent_store(self):
+        return TorrentStore(
+            self.qbitclient,
+            self.config.get("listPageSize", DEFAULT_PAGE_SIZE),
+            self.config.get("listSortKey", DEFAULT_SORT),
+        )
+
+    def measure(self, function):
+        """runs a function
+        Returns:
+            dict of wall time in seconds, API request count and requests by endpoint
+        """
+        self.fake.calls.clear()
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        return {
+            "seconds": seconds,
+            "calls": sum(self.fake.calls.values()),
+            "endpoints": dict(sorted(self.fake.calls.items())),
+        }
+
+    def close(self):
+        self.api.stop()
+        self.fake.stop()
+
+
+def ticks(world, tick):
+    return {"first": world.measure(tick), "idle": world.measure(tick)}
+
+
+def bench_limits(world, args):
+    torrent_store = world.torrent_store()
+    share_limiter = ShareLimiter(
+        world.config, world.qbitclient, torrent_store, world.api
+    )
+    return ticks(world, lambda: (torrent_store.sync(), share_limiter.set_limits()))
+
+
+def bench_cleaner(world, args):
+    torrent_store = world.torrent_store()
+    cleaner = Cleaner(
+        world.config,
+        world.qbitclient,
+        torrent_store,
+        world.genre_resolver,
+        world.journal,
+    )
+    return ticks(world, lambda: (torrent_store.sync(), cleaner.clean_seeds(0)))
+
+
+def bench_plex(world, args):
+    torrent_store = world.torrent_store()
+    scan_coordinator = ScanCoordinator(world.config)
+    plex_scanner = PlexScanner(
+        world.config,
+        world.qbitclient,
+        torrent_store,
+        world.genre_resolver,
+        world.journal,
+        scan_coordinator,
+    )
+
+    def tick():
+        torrent_store.sync()
+        plex_scanner.scan_if_needed()
+        scan_coordinator.flush()
+
+    return ticks(world, tick)
+
+
+def bench_copier(world, args):
+    def copy():
+        copier = Copier(
+            world.config,
+            world.qbitclient,
+            world.genre_resolver,
+            world.journal,
+            ScanCoordinator(world.config),
+            world.api,
+        )
+        copier.copy_completes()
+
+    return {"run": world.measure(copy)}
+
+
+def bench_add_rule(world, args):
+    def add_rules():
+        for i in range(args.rules):
+            AddCategory(
+                world.config, world.qbitclient, f"New Show {i}", "tv"
+            ).add_category()
+            RSSRule(world.config, world.qbitclient, f"New Show {i}", "tv").add_rule()
+
+    return {"run": world.measure(add_rules)}
+
+
+def bench_import(world, args):
+    entries = [(f"New Show {i}", "tv") for i in range(args.rules)]
+    importer = Importer(world.config, world.qbitclient, world.api)
+    return ticks(world, lambda: importer.run(entries))
+
+
+BENCHES = {
+    "limits": bench_limits,
+    "cleaner": bench_cleaner,
+    "plex": bench_plex,
+    "copier": bench_copier,
+    "add-rule": bench_add_rule,
+    "import": bench_import,
+}
+
+
+def compare(results, baseline, tolerance):
+    """prints results next to the baseline
+    Returns:
+        list of rows that got slower than the tolerance allows or send more API requests
+    """
+    regressions = []
+    print(
+        f"{'case':<18}{'seconds':>10}{'calls':>9}{'base s':>10}{'base calls':>12}{'change':>9}"
+    )
+    for row, result in results.items():
+        base = baseline.get(row)
+        line = f"{row:<18}{result['seconds']:>10.3f}{result['calls']:>9}"
+        if base:
+            change = result["seconds"] / base["seconds"] - 1 if base["seconds"] else 0
+            line += f"{base['seconds']:>10.3f}{base['calls']:>12}{change:>+9.0%}"
+            if change > tolerance or result["calls"] > base["calls"]:
+                regressions.append(row)
+                line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark qbitmgr tasks")
+    parser.add_argument("-torrents", type=int, default=5000)
+    parser.add_argument("-groups", type=int, default=20, help="share limit groups")
+    parser.add_argument(
+        "-content", type=int, default=100, help="completed torrents with files on disk"
+    )
+    parser.add_argument("-file-size", dest="file_size", type=int, default=262144)
+    parser.add_argument(
+        "-rules", type=int, default=50, help="rules added by add-rule and import"
+    )
+    parser.add_argument(
+        "-latency", type=float, default=0, help="milliseconds added to each request"
+    )
+    parser.add_argument("-cases", default=",".join(CASES))
+    parser.add_argument(
+        "-set",
+        action="append",
+        default=[],
+        help="config override in toml, e.g. -set 'cleanerWorkers = 4'",
+    )
+    parser.add_argument("-baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "-save", action="store_true", help="save these results as the baseline"
+    )
+    parser.add_argument(
+        "-tolerance", type=float, default=0.2, help="allowed slowdown against baseline"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    params = {
+        key: getattr(args, key)
+        for key in (
+            "torrents",
+            "groups",
+            "content",
+            "file_size",
+            "rules",
+            "latency",
+            "set",
+        )
+    }
+    results = {}
+    for case in args.cases.split(","):
+        with tempfile.TemporaryDirectory(prefix="qbitmgr-bench-") as root:
+            world = World(args, root)
+            try:
+                for tick, result in BENCHES[case](world, args).items():
+                    results[
+                        case if tick in ("first", "run") else f"{case} ({tick})"
+                    ] = result
+            finally:
+                world.close()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            saved = json.load(file)
+        if saved["params"] == params:
+            baseline = saved["results"]
+        else:
+            print(
+                f"Ignoring baseline made with different parameters: {saved['params']}"
+            )
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.baseline, "w") as file:
+            json.dump({"params": params, "results": results}, file, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
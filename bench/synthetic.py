@@ -0,0 +1,213 @@
+"""
+generates a qbitmgr config, a torrent table for FakeQbittorrent and on-disk content trees to benchmark against
+most completed torrents are generated as already handled (tagged), as in a long running client,
+while the first content_count completed torrents get real files and still need processing
+"""
+
+import hashlib
+import os
+import random
+import time
+
+DOWNLOADING = ["downloading", "stalledDL", "queuedDL", "pausedDL"]
+SEEDING = ["uploading", "stalledUP", "queuedUP"]
+OPEN_TRACKER = "udp://open.example.net:1337/announce"
+
+
+def make_config(root, group_count):
+    """builds a config like config.toml with share limit groups and two genres under root
+    Args:
+        root: directory the downloads and media libraries are created in
+        group_count: number of tracker based share limit groups
+    Returns:
+        config dict
+    """
+    rss_rules = {
+        "enabled": True,
+        "mustContain": "1080p",
+        "mustNotContain": "",
+        "useRegex": False,
+        "episodeFilter": "",
+        "smartFilter": False,
+        "previouslyMatchedEpisodes": "",
+        "affectedFeeds": ["http://feed.example.net/rss"],
+        "ignoreDays": 0,
+        "lastMatch": "",
+        "addPaused": False,
+        "assignedCategory": "",
+        "savePath": "",
+    }
+    share_limits = {
+        f"group{i}": {
+            "priorityInQueue": True,
+            "trackers": [f"tracker{i}.example.org"],
+            "categories": [],
+            "ratio_limit": 2 + i % 3,
+            "seeding_time_limit": 1440 * (1 + i % 4),
+            "upload_speed_limit": 1048576 * (1 + i % 8),
+            "tags": f"Group{i}",
+            "weight": 1 + i % 3,
+        }
+        for i in range(group_count)
+    }
+    share_limits["default"] = {
+        "priorityInQueue": True,
+        "trackers": [],
+        "categories": [],
+        "ratio_limit": 2,
+        "seeding_time_limit": 1440,
+        "upload_speed_limit": 7500000,
+        "tags": "Default",
+        "weight": 1,
+    }
+    tv_dir = os.path.join(root, "media", "TV")
+    return {
+        "logLevel": "WARNING",
+        "checkInterval": 1,
+        "cleanerInterval": 10,
+        "completeDownloadsDir": os.path.join(root, "downloads"),
+        "plexScanCommand": ["true"],
+        "plexScanDebounce": 30,
+        "plexLibrarySections": [{"path": tv_dir, "section": 1}],
+        "shareLimits": share_limits,
+        "genres": {
+            "tv": {
+                "moveToDir": tv_dir,
+                "keepDirStructure": True,
+                "keepSpecificFileTypes": [".mkv"],
+                "deleteFromClientWhenDone": False,
+                "scanPlex": True,
+                "scriptOnDone": "",
+                "regexReplaceSeparators": ".",
+                "rssRules": dict(rss_rules),
+            },
+            "iso": {
+                "moveToDir": os.path.join(root, "media", "ISO"),
+                "keepDirStructure": False,
+                "keepSpecificFileTypes": [".iso"],
+                "deleteFromClientWhenDone": True,
+                "scanPlex": False,
+                "scriptOnDone": "",
+                "regexReplaceSeparators": "",
+                "rssRules": dict(rss_rules),
+            },
+        },
+    }
+
+
+def write_file(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(os.urandom(size))
+
+
+def populate(fake, config, torrent_count, content_count, file_size, seed=0):
+    """adds generated torrents to a FakeQbittorrent and writes content for the ones that still need processing
+    Args:
+        fake: FakeQbittorrent obj
+        config: config dict from make_config
+        torrent_count: number of torrents
+        content_count: number of completed torrents given real files that still need processing
+        file_size: bytes in each torrent's main file
+        seed: random seed, the same seed generates the same table
+    Returns: None
+    """
+    rng = random.Random(seed)
+    now = int(time.time())
+    groups = [i for i in config["shareLimits"] if i != "default"]
+    # downloads are saved as <completeDownloadsDir>/<genre>/<category> and copied into the libraries from there
+    tv_dir = os.path.join(config["completeDownloadsDir"], "tv")
+    iso_dir = os.path.join(config["completeDownloadsDir"], "iso")
+    shows = [f"Show {i}" for i in range(max(1, torrent_count // 50))]
+    queue_position = 0
+    for i in range(torrent_count):
+        hash_ = hashlib.sha1(f"torrent{i}".encode()).hexdigest()
+        group = rng.choice(groups) if groups else "default"
+        roll = rng.random()
+        if roll < 0.5 and groups:
+            trackers = [
+                f"https://{config['shareLimits'][group]['trackers'][0]}/announce?passkey={i:032x}"
+            ]
+        elif roll < 0.75:
+            trackers = [
+                OPEN_TRACKER,
+                f"udp://tracker{rng.randrange(1000)}.example.com:6969/announce",
+                f"https://{config['shareLimits'][group]['trackers'][0] if groups else 'public.example.org'}/announce",
+            ]
+        else:
+            trackers = [OPEN_TRACKER]
+        roll = rng.random()
+        if roll < 0.3:
+            state = rng.choice(DOWNLOADING)
+        elif roll < 0.7:
+            state = rng.choice(SEEDING)
+        else:
+            state = "pausedUP"
+        completed = state not in DOWNLOADING
+        if rng.random() < 0.8:
+            show = rng.choice(shows)
+            category = f"TV - {show}"
+            save_path = os.path.join(tv_dir, show)
+            name = f"{show.replace(' ', '.')}.E{i:06d}.1080p"
+            content_path = os.path.join(save_path, name)
+            files = [
+                (f"{name}/{name}.mkv", file_size),
+                (f"{name}/{name}.nfo", 1024),
+                (f"{name}/sample.txt", 4096),
+            ]
+        else:
+            category = "ISO - Linux"
+            save_path = os.path.join(iso_dir, "Linux")
+            # single file torrents get a subfolder too with the 'create subfolder' content layout
+            name = f"distro-{i}"
+            content_path = os.path.join(save_path, name, f"{name}.iso")
+            files = [(f"{name}/{name}.iso", file_size)]
+        tags = []
+        if completed:
+            tags.append(config["shareLimits"][group]["tags"])
+            if content_count > 0:
+                content_count -= 1
+                for file_name, size in files:
+                    write_file(os.path.join(save_path, file_name), size)
+            else:
+                tags.extend(["Copied", "Scanned"])
+                if state == "pausedUP":
+                    tags.append("Processed")
+        elif rng.random() < 0.3:
+            tags.append(config["shareLimits"][group]["tags"])
+        limits = config["shareLimits"][group] if tags else {}
+        if not completed:
+            queue_position += 1
+        leechers = rng.choice([0, 0, 0, 1, 2, 5, 20])
+        fake.add_torrent(
+            {
+                "hash": hash_,
+                "name": name,
+                "state": state,
+                "tags": ", ".join(sorted(tags)),
+                "category": category,
+                "save_path": save_path,
+                "content_path": content_path,
+                "size": sum(size for _, size in files),
+                "progress": 1 if completed else rng.random(),
+                "added_on": now - rng.randrange(86400 * 60),
+                "completion_on": (
+                    now - rng.randrange(3600, 86400 * 30) if completed else -1
+                ),
+                "tracker": trackers[0],
+                "trackers_count": len(trackers),
+                "ratio": rng.random() * 3 if completed else 0,
+                "ratio_limit": limits.get("ratio_limit", -2),
+                "seeding_time": rng.randrange(86400 * 7) if completed else 0,
+                "seeding_time_limit": limits.get("seeding_time_limit", -2),
+                "up_limit": limits.get("upload_speed_limit", -1),
+                "upspeed": rng.randrange(1048576) if leechers else 0,
+                "dlspeed": 0 if completed else rng.randrange(4194304),
+                "num_leechs": min(leechers, 5),
+                "num_incomplete": leechers,
+                "num_complete": rng.randrange(50),
+                "priority": 0 if completed else queue_position,
+            },
+            trackers,
+            files,
+        )
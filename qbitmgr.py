@@ -4,15 +4,12 @@ import logging
 from logging.handlers import TimedRotatingFileHandler
 from pathlib import Path
 
-import qbittorrentapi
 import toml
 
-from utils.add_cat import AddCategory
-from utils.add_rule import RSSRule
-from utils.cleaner import Cleaner
-from utils.plex_scanner import PlexScanner
-from utils.scheduler import Periodic
-from utils.set_limits import ShareLimiter
+from utils.control import send_command
+
+# commands the run daemon can carry out, with the session it is already logged in with
+DAEMON_COMMANDS = ("add-rule", "add-cat", "import", "clean", "set-limits")
 
 
 def get_logger(name, log_level):
@@ -53,10 +50,42 @@ def get_args(genres):
     parser.add_argument(
         "cmd",
         default="",
-        choices=["run", "add-cat", "add-rule", "clean", "set-limits"],
+        choices=[
+            "run",
+            "add-cat",
+            "add-rule",
+            "import",
+            "clean",
+            "set-limits",
+            "notify",
+        ],
         help="Command to run",
     )
+    parser.add_argument(
+        "hash",
+        nargs="?",
+        default="",
+        help="Torrent hash for 'notify', e.g. %%I in qbittorrent's run external program setting",
+    )
     parser.add_argument("-name", required=False, default="", help="Person's name")
+    parser.add_argument(
+        "-file",
+        required=False,
+        default="-",
+        help="With 'import': csv of name,genre rows or .toml of genre = [names] to import, '-' for stdin",
+    )
+    parser.add_argument(
+        "-instance",
+        required=False,
+        default="",
+        help="Name of the qbittorrent instance from [[instances]] to act on, all of them if not given",
+    )
+    parser.add_argument(
+        "-dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="With 'clean' or 'import': log what would change without changing anything",
+    )
     parser.add_argument(
         "-genre",
         required=False,
@@ -68,70 +97,184 @@ def get_args(genres):
     return parser.parse_args()
 
 
-def periodic_tasks(
-    share_limiter: ShareLimiter,
-    cleaner: Cleaner,
-    plex_scanner: PlexScanner,
-    ignore_age: int,
-):
-    share_limiter.set_limits()
-    cleaner.clean_seeds(ignore_age)
-    plex_scanner.scan_if_needed()
+def notify(socket_path, torrent_hash):
+    """tells the run daemon that a torrent is complete"""
+    try:
+        response = send_command(socket_path, {"cmd": "notify", "hash": torrent_hash})
+    except (OSError, ValueError) as e:
+        print(f"Could not reach the qbitmgr daemon at {socket_path}: {e}")
+        return 1
+    if not response.get("ok"):
+        print(response.get("error"))
+        return 1
+    return 0
+
+
+def delegate(socket_path, args):
+    """runs a command on the running daemon
+    Returns:
+        exit code, None if no daemon is running
+    """
+    request_args = {
+        key: getattr(args, key, None)
+        for key in ("cmd", "name", "genre", "instance", "dry_run", "entries")
+    }
+    try:
+        # clean and set-limits wait for the daemon's task to finish, however long it takes
+        response = send_command(
+            socket_path, {"cmd": "command", "args": request_args}, timeout=None
+        )
+    except OSError:
+        return None
+    except ValueError as e:
+        # the daemon took the command and may have carried it out, so it is not run again here
+        print(f"Bad reply from the qbitmgr daemon at {socket_path}: {e}")
+        return 1
+    if "results" not in response:
+        print(response.get("error"))
+        return 1
+    for name, result in response["results"].items():
+        print(f"{name}: {result or 'done'}")
+    for name, error in response["errors"].items():
+        print(f"{name}: {args.cmd} failed: {error}")
+    return 0 if response["ok"] else 1
 
 
 def main():
     config = toml.load(Path(Path(__file__).resolve().parent, "config.toml"))
-    args = get_args(list(config["genres"]))
-    log = get_logger("qbitmgr", config["logLevel"])
-    qbitclient = qbittorrentapi.Client(
-        host=config["host"],
-        username=config["username"],
-        password=config["password"],
+    genres = set(config["genres"])
+    for entry in config.get("instances", []):
+        genres.update(entry.get("genres", {}))
+    args = get_args(sorted(genres))
+    socket_path = Path(
+        Path(__file__).resolve().parent, config.get("controlSocket", "qbitmgr.sock")
     )
+    if args.cmd == "notify":
+        return notify(socket_path, args.hash)
+    if args.cmd == "import":
+        from utils.importer import read_entries
+
+        args.entries = read_entries(args.file, args.genre)
+    # dry runs stay in this process so their log of what would change is shown here
+    if args.cmd in DAEMON_COMMANDS and not args.dry_run:
+        exit_code = delegate(socket_path, args)
+        if exit_code is not None:
+            return exit_code
+
+    # imported once no daemon can take the command, so commands it takes start quickly
+    from utils import commands
+    from utils.config import ConfigError
+    from utils.instances import Instance, instance_configs
+
+    log = get_logger("qbitmgr", config["logLevel"])
+    try:
+        configs = instance_configs(config)
+    except ConfigError as e:
+        log.error(e)
+        return 1
+    if args.instance and args.instance not in configs:
+        print(
+            f"Unknown qbittorrent instance {args.instance}, choose from {list(configs)}"
+        )
+        return 1
+    instances = [
+        Instance(name, instance_config, Path(__file__).resolve().parent)
+        for name, instance_config in configs.items()
+        if not args.instance or name == args.instance
+    ]
     try:
         if args.cmd == "run":
-            log.info(
-                f"Scheduling tasks to run every: {config['checkInterval']} minutes"
-            )
-            share_limiter = ShareLimiter(config, qbitclient)
-            cleaner = Cleaner(config, qbitclient)
-            plex_scanner = PlexScanner(config, qbitclient)
-            Periodic(
-                config["checkInterval"] * 60,
-                periodic_tasks,
-                share_limiter,
-                cleaner,
-                plex_scanner,
-                20,
+            from utils.config import ConfigWatcher
+            from utils.control import ControlServer
+            from utils.device_limits import DeviceLimiter
+            from utils.metrics import MetricsServer
+            from utils.scheduler import Scheduler
+
+            device_limiter = DeviceLimiter(config.get("cleanerWorkersPerDevice", 1))
+            scheduler = Scheduler()
+            prefixes = {
+                instance.name: f"{instance.name}:" if len(instances) > 1 else ""
+                for instance in instances
+            }
+            instance_tasks = [
+                commands.InstanceTasks(
+                    scheduler,
+                    instance,
+                    prefixes[instance.name],
+                    device_limiter,
+                )
+                for instance in instances
+            ]
+            for tasks in instance_tasks:
+                tasks.schedule()
+            if config.get("configReloadInterval", 10) > 0:
+                config_watcher = ConfigWatcher(
+                    Path(Path(__file__).resolve().parent, "config.toml"),
+                    lambda raw: {
+                        name: instance_config
+                        for name, instance_config in instance_configs(raw).items()
+                        if not args.instance or name == args.instance
+                    },
+                    commands.reload_handler(instance_tasks),
+                )
+                scheduler.add(
+                    "config",
+                    config.get("configReloadInterval", 10),
+                    config_watcher.check,
+                )
+            for task in scheduler.tasks.values():
+                log.info(
+                    f"Scheduling {task.name} to run every {task.interval / 60:g} minutes"
+                )
+            control_server = ControlServer(
+                socket_path,
+                {
+                    "notify": commands.notify_handler(
+                        scheduler, [tasks.notify_queue for tasks in instance_tasks]
+                    ),
+                    "command": commands.command_handler(scheduler, instances, prefixes),
+                },
             )
-        elif args.cmd == "add-rule":
-            log.debug("User call to: add new RSS auto downloading rule")
-            category = AddCategory(config, qbitclient, args.name, args.genre)
-            category.add_category()
-            rule = RSSRule(config, qbitclient, args.name, args.genre)
-            rule.add_rule()
-        elif args.cmd == "add-cat":
-            log.debug("User call to: add new category")
-            category = AddCategory(config, qbitclient, args.name, args.genre)
-            category.add_category()
-        elif args.cmd == "clean":
-            log.debug("User call to: clean seeds")
-            cleaner = Cleaner(config, qbitclient)
-            cleaner.clean_seeds(10)
-        elif args.cmd == "set-limits":
-            log.debug("User call to: set limits")
-            share_limiter = ShareLimiter(config, qbitclient)
-            share_limiter.set_limits()
+            try:
+                control_server.start()
+            except OSError as e:
+                log.error(f"Could not listen for commands: {e}")
+                return 1
+            metrics_server = None
+            if config.get("metricsPort"):
+                metrics_server = MetricsServer(
+                    config.get("metricsHost", "127.0.0.1"), config["metricsPort"]
+                )
+                metrics_server.start()
+            scheduler.run_forever()
+            control_server.stop()
+            if metrics_server:
+                metrics_server.stop()
+            for tasks in instance_tasks:
+                tasks.scan_coordinator.flush()
+        elif args.cmd in commands.COMMANDS:
+            for instance in instances:
+                try:
+                    result = commands.COMMANDS[args.cmd](instance, args)
+                    if result:
+                        print(f"{instance.name}: {result}")
+                except Exception as e:
+                    log.exception(
+                        f"{args.cmd} failed for qbittorrent instance {instance.name}: {e}"
+                    )
         else:
             print(
                 "Command not recognized or incorrect flags given. Choose 'run,' 'clean,' or 'set-limits' with no flags or "
-                "'add-rule'/'add-cat' with --genre and --name"
+                "'add-rule'/'add-cat' with --genre and --name or 'import' with --file"
             )
     except KeyboardInterrupt:
         log.info("Qbitmgr was interrupted by Ctrl + C")
     except Exception as e:
         log.exception(f"Unexpected fatal exception occurred: {e}")
+    finally:
+        for instance in instances:
+            instance.close()
 
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
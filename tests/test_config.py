@@ -0,0 +1,32 @@
+import pytest
+
+from bench.synthetic import make_config
+from utils.config import Config, ConfigError
+
+
+def test_config_values_are_read_only(tmp_path):
+    raw = make_config(str(tmp_path), 1)
+    config = Config(raw)
+
+    with pytest.raises(TypeError):
+        config["shareLimits"]["default"]["ratio_limit"] = 5
+    with pytest.raises(AttributeError):
+        config["genres"]["tv"]["keepSpecificFileTypes"].append(".srt")
+    raw["shareLimits"]["default"]["ratio_limit"] = 5
+    assert config["shareLimits"]["default"]["ratio_limit"] == 2
+
+
+@pytest.mark.parametrize(
+    "table, value, problem",
+    [
+        ("shareLimits", {"default": 1}, "shareLimits.default: must be a table"),
+        ("shareLimits", [], "shareLimits: must be a table of groups"),
+        ("genres", {"tv": "TV"}, "genres.tv: must be a table"),
+    ],
+)
+def test_tables_of_the_wrong_type_are_config_errors(tmp_path, table, value, problem):
+    raw = make_config(str(tmp_path), 1)
+    raw[table] = value
+
+    with pytest.raises(ConfigError, match=problem):
+        Config(raw)
@@ -0,0 +1,33 @@
+import os
+import socket
+
+import pytest
+
+from utils.control import ControlServer, send_command
+
+
+def test_a_second_daemon_does_not_take_over_the_socket(tmp_path):
+    path = str(tmp_path / "qbitmgr.sock")
+    running = ControlServer(path, {"ping": lambda request: {"ok": True}})
+    running.start()
+    try:
+        with pytest.raises(OSError):
+            ControlServer(path, {}).start()
+        assert send_command(path, {"cmd": "ping"}) == {"ok": True}
+    finally:
+        running.stop()
+
+
+def test_a_stale_socket_is_replaced(tmp_path):
+    path = str(tmp_path / "qbitmgr.sock")
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    assert os.path.exists(path)
+
+    server = ControlServer(path, {"ping": lambda request: {"ok": True}})
+    server.start()
+    try:
+        assert send_command(path, {"cmd": "ping"}) == {"ok": True}
+    finally:
+        server.stop()
@@ -0,0 +1,99 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from bench.synthetic import make_config, write_file
+from utils.config import Config
+from utils.copier import CompletedDownload, Copier
+from utils.genres import GenreResolver
+from utils.journal import Journal
+
+
+@pytest.mark.parametrize("from_file_list", [True, False])
+@pytest.mark.parametrize("link", [True, False])
+def test_copying_a_torrent_twice(tmp_path, monkeypatch, link, from_file_list):
+    monkeypatch.setattr("utils.copier.same_device", lambda *args: link)
+    config = Config(make_config(str(tmp_path), 1))
+    save_path = os.path.join(tmp_path, "downloads", "Show")
+    name = "Show.E01.1080p"
+    files = [
+        (os.path.join(save_path, name, f"{name}.mkv"), 4096),
+        (os.path.join(save_path, name, "Extras", "Featurette.mkv"), 2048),
+        (os.path.join(save_path, name, "sample.txt"), 1024),
+    ]
+    for path, size in files:
+        write_file(path, size)
+
+    destination_dir = os.path.join(config.genres["tv"].move_to_dir, "TV - Show", name)
+    destinations = [
+        os.path.join(destination_dir, "Extras", "Featurette.mkv"),
+        os.path.join(destination_dir, f"{name}.mkv"),
+    ]
+    for _ in range(2):
+        download = CompletedDownload(
+            config,
+            name,
+            "0" * 40,
+            os.path.join(save_path, name),
+            save_path,
+            "TV - Show",
+            "tv",
+        )
+        if from_file_list:
+            download.list_files_from_torrent(files)
+        else:
+            download.list_files_with_exts()
+        download.copy_subtree()
+        assert sorted(download.copied_paths) == destinations
+        assert download.check_copy_completed()
+
+    with open(files[0][0], "rb") as source, open(destinations[1], "rb") as copy:
+        assert source.read() == copy.read()
+    assert sorted(os.listdir(destination_dir)) == ["Extras", f"{name}.mkv"]
+
+
+class CompletedTorrents:
+    """answers torrents_info with a fixed list of completed torrents"""
+
+    def __init__(self, torrents):
+        self.torrents = torrents
+
+    def torrents_info(self, status_filter=None, sort=None, limit=None, offset=0):
+        return self.torrents[offset : offset + limit] if limit else self.torrents
+
+
+def test_downloads_are_copied_only_from_outside_the_library(tmp_path):
+    config = Config(make_config(str(tmp_path), 1))
+    library = config.genres["tv"].move_to_dir
+
+    def torrent(hash, save_path, category):
+        return SimpleNamespace(
+            name="Show.E01.1080p",
+            hash=hash * 40,
+            tags="",
+            content_path=os.path.join(save_path, "Show.E01.1080p"),
+            save_path=save_path,
+            category=category,
+        )
+
+    torrents = [
+        torrent("1", os.path.join(tmp_path, "downloads", "Show"), "TV - Show"),
+        torrent("2", os.path.join(library, "Show"), "TV - Show"),
+        torrent("3", os.path.join(library, "TV - Show"), "TV - Show"),
+        torrent("4", os.path.join(tmp_path, "downloads", "tv", "Other"), "Other"),
+        torrent("5", os.path.join(tmp_path, "downloads", "Misc"), "Misc"),
+    ]
+    copier = Copier(
+        config,
+        CompletedTorrents(torrents),
+        GenreResolver(config.genres),
+        Journal(os.path.join(tmp_path, "qbitmgr.db")),
+        None,
+    )
+
+    to_copy = {i.hash[0]: i for i in copier.to_copy}
+    assert sorted(to_copy) == ["1", "4"]
+    assert to_copy["1"].genre == "tv"
+    assert to_copy["1"].destination_dir == os.path.join(library, "TV - Show")
+    assert to_copy["4"].genre == "tv"
@@ -0,0 +1,25 @@
+import pytest
+
+from bench.fake_qbittorrent import FakeQbittorrent
+from utils.metrics import InstrumentedClient, render
+
+
+@pytest.fixture
+def fake():
+    fake = FakeQbittorrent()
+    yield fake
+    fake.stop()
+
+
+def test_requests_are_labelled_with_the_api_path(fake):
+    client = InstrumentedClient(
+        host=fake.start(), username="admin", password="adminadmin", instance="test"
+    )
+    client.torrents_add_tags(tags="Copied", torrent_hashes="0" * 40)
+
+    rendered = render()
+    assert (
+        'qbitmgr_api_requests_total{instance="test",endpoint="torrents/addTags",outcome="ok"} 1'
+        in rendered
+    )
+    assert "APINames" not in rendered
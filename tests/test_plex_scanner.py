@@ -0,0 +1,21 @@
+from bench.synthetic import make_config
+from utils.config import Config
+from utils.plex_scanner import ScanCoordinator
+
+
+def test_a_queued_torrent_is_requested_once_until_its_scan_finishes(tmp_path):
+    raw = make_config(str(tmp_path), 1)
+    raw["plexScanDebounce"] = 3600
+    coordinator = ScanCoordinator(Config(raw))
+    library = raw["genres"]["tv"]["moveToDir"]
+    outcomes = []
+
+    assert coordinator.request(library + "/Show", outcomes.append, key="a" * 40)
+    assert not coordinator.request(library + "/Show", outcomes.append, key="a" * 40)
+    assert coordinator.is_queued("a" * 40)
+
+    coordinator.flush()
+    assert outcomes == [True]
+    assert not coordinator.is_queued("a" * 40)
+    assert coordinator.request(library + "/Show", outcomes.append, key="a" * 40)
+    coordinator.flush()
@@ -0,0 +1,33 @@
+from types import SimpleNamespace
+
+from bench.synthetic import make_config
+from utils.config import Config
+from utils.set_limits import ShareLimiter
+
+
+def limiter(tmp_path, **settings):
+    raw = make_config(str(tmp_path), 2)
+    raw.update(settings)
+    return ShareLimiter(Config(raw), None, None)
+
+
+def test_torrents_tagged_for_several_groups_belong_to_the_first_in_config(tmp_path):
+    share_limiter = limiter(
+        tmp_path,
+        uploadAllocator={"enabled": True, "globalUploadLimit": 10485760},
+        queueOptimizer=True,
+    )
+    allocator = share_limiter.allocator
+    weights = share_limiter.config.share_groups
+
+    for tags, group in [
+        ({"Default", "Group1"}, "group1"),
+        ({"Group1", "Group0"}, "group0"),
+        ({"Default", "Unrelated"}, "default"),
+        ({"Unrelated"}, "default"),
+    ]:
+        torrent = SimpleNamespace(tags=frozenset(tags))
+        assert allocator.torrent_group(torrent) == group
+        assert (
+            share_limiter.queue_optimizer.weight(torrent.tags) == weights[group].weight
+        )
@@ -12,7 +12,7 @@ class AddCategory:
     def __init__(self, config, qbitclient, name, genre):
         self.qbitclient = qbitclient
         self.name = f"{genre.upper()} - {name}"
-        self.save_path = Path(config["genres"][genre]["moveToDir"], name)
+        self.save_path = Path(config.genres[genre].move_to_dir, name)
 
     def add_category(self):
         """adds download category"""
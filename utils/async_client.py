@@ -0,0 +1,202 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock, Thread
+
+import qbittorrentapi
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger(__name__)
+
+
+class SerialClient:
+    """runs batches of client calls one after another, used when asyncMode is off"""
+
+    def __init__(self, qbitclient):
+        self.qbitclient = qbitclient
+
+    def gather(self, calls):
+        """runs client calls
+        Args:
+            calls: list of (qbitclient method name, args, kwargs)
+        Returns:
+            list of results in the same order
+        """
+        return [
+            getattr(self.qbitclient, method)(*args, **kwargs)
+            for method, args, kwargs in calls
+        ]
+
+    def stop(self):
+        pass
+
+
+class AsyncClient:
+    """
+    runs qbittorrentapi client calls from an asyncio event loop in its own thread, at most max_in_flight at once.
+    requests share a keep-alive connection pool sized to the in-flight limit and have a timeout each.
+    connection errors and 5xx responses are retried with exponential backoff, and a 403 logs in again
+    (once for all calls that hit it) before retrying
+    """
+
+    def __init__(self, qbitclient, max_in_flight=8, timeout=15, retries=3, backoff=0.5):
+        self.qbitclient = qbitclient
+        self.max_in_flight = max(1, max_in_flight)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_in_flight, thread_name_prefix="qbt-api"
+        )
+        self._semaphore = None
+        self._pooled_session = None
+        self._session_lock = Lock()
+        self._login_lock = Lock()
+        self._logins = 0
+        self._thread = None
+        # qbittorrentapi logs in again by itself on a 403, resetting the session other calls are using.
+        # route every login through one lock so concurrent calls rejected together log in once
+        self._auth_log_in = qbitclient.auth_log_in
+        qbitclient.auth_log_in = self.auth_log_in
+
+    def start(self):
+        """runs the event loop in a background thread"""
+
+        async def make_semaphore():
+            return asyncio.Semaphore(self.max_in_flight)
+
+        self._thread = Thread(
+            target=self.loop.run_forever, name="qbt-async", daemon=True
+        )
+        self._thread.start()
+        self._semaphore = asyncio.run_coroutine_threadsafe(
+            make_semaphore(), self.loop
+        ).result()
+        log.debug(
+            f"Async API client started with {self.max_in_flight} requests in flight"
+        )
+
+    def stop(self):
+        if self._thread:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+        self._executor.shutdown()
+        self.qbitclient.auth_log_in = self._auth_log_in
+
+    def session(self):
+        """the client's requests session, given a connection pool as large as the in-flight limit.
+        qbittorrentapi builds a new session when it logs in again, so the pool is mounted on each new one
+        """
+        with self._session_lock:
+            session = self.qbitclient._session
+            if session is not self._pooled_session:
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.max_in_flight,
+                    pool_block=True,
+                    max_retries=Retry(total=0, raise_on_status=False),
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._pooled_session = session
+            return session
+
+    def auth_log_in(self, *args, **kwargs):
+        """logs in unless another call did while this one waited for the lock"""
+        logins_seen = self._logins
+        with self._login_lock:
+            if self._logins != logins_seen:
+                return
+            log.debug("Logging in to qBittorrent")
+            self._auth_log_in(*args, **kwargs)
+            self._logins += 1
+
+    def blocking_call(self, method, args, kwargs):
+        self.session()
+        kwargs = dict(kwargs)
+        kwargs.setdefault("requests_args", {"timeout": self.timeout})
+        return getattr(self.qbitclient, method)(*args, **kwargs)
+
+    async def request(self, method, *args, **kwargs):
+        """awaits a client call
+        Args:
+            method: qbitclient method name such as 'torrents_add_tags'
+            args, kwargs: arguments of the method
+        Returns:
+            the method's result
+        """
+        loop = asyncio.get_running_loop()
+        logged_in = False
+        attempt = 0
+        async with self._semaphore:
+            while True:
+                try:
+                    return await loop.run_in_executor(
+                        self._executor,
+                        partial(self.blocking_call, method, args, kwargs),
+                    )
+                except qbittorrentapi.HTTP403Error:
+                    if logged_in:
+                        raise
+                    logged_in = True
+                    log.info("qBittorrent rejected the session, logging in again")
+                    await loop.run_in_executor(self._executor, self.auth_log_in)
+                except qbittorrentapi.APIConnectionError as e:
+                    retryable = isinstance(
+                        e, qbittorrentapi.HTTP5XXError
+                    ) or not isinstance(
+                        e, (qbittorrentapi.HTTPError, qbittorrentapi.LoginFailed)
+                    )
+                    if not retryable or attempt >= self.retries:
+                        raise
+                    delay = self.backoff * 2**attempt
+                    attempt += 1
+                    log.warning(f"{method} failed, retrying in {delay:g}s: {e}")
+                    await asyncio.sleep(delay)
+
+    def gather(self, calls):
+        """runs client calls concurrently from synchronous code and waits for all of them
+        Args:
+            calls: list of (qbitclient method name, args, kwargs)
+        Returns:
+            list of results in the same order
+        Raises:
+            the first error once every call has finished
+        """
+        if not calls:
+            return []
+        if not self.qbitclient.is_logged_in:
+            self.auth_log_in()
+
+        async def run():
+            return await asyncio.gather(
+                *(
+                    self.request(method, *args, **kwargs)
+                    for method, args, kwargs in calls
+                ),
+                return_exceptions=True,
+            )
+
+        results = asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+
+def make_api(config, qbitclient):
+    """builds the client that runs batches of api calls: concurrent with asyncMode on, one by one otherwise"""
+    if not config.get("asyncMode", False):
+        return SerialClient(qbitclient)
+    api = AsyncClient(
+        qbitclient,
+        max_in_flight=config.get("apiMaxInFlight", 8),
+        timeout=config.get("apiTimeout", 15),
+        retries=config.get("apiRetries", 3),
+    )
+    api.start()
+    return api
@@ -3,8 +3,15 @@ import os
 import shutil
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from utils.device_limits import DeviceLimiter
+from utils.fs_plan import FsPlan, torrent_file_list
+from utils.journal import DONE, FAILED, PENDING, RUNNING
+from utils.metrics import count_file
+from utils.torrent_store import SEEDING_STATES
+
 log = logging.getLogger(__name__)
 
 
@@ -27,8 +34,12 @@ class CompletedSeed:
         save_path,
         completion_on,
         genre,
+        dry_run=False,
+        read_disk=False,
     ):
         self.config = config
+        self.instance = config.get("name", "default")
+        self.dry_run = dry_run
         self.genre = genre
         self.qbitclient = qbitclient
         self.name = name
@@ -38,9 +49,13 @@ class CompletedSeed:
         )  # path of torrent content (root path for multi-file torrents, absolute file path for single-file torrents)
         self.save_path = Path(save_path)
         self.time_complete = self.elapsed_seconds(completion_on)
-        self.keep_dir_structure = config["genres"][genre]["keepDirStructure"]
-        self.delete_from_client = config["genres"][genre]["deleteFromClientWhenDone"]
-        self.file_exts_to_keep = tuple(config["genres"][genre]["keepSpecificFileTypes"])
+        self.keep_dir_structure = config.genres[genre].keep_dir_structure
+        self.delete_from_client = config.genres[genre].delete_from_client
+        self.file_exts_to_keep = config.genres[genre].keep_extensions
+        self.script_on_done = config.genres[genre].script_on_done
+        # files are planned from qbittorrent's file list unless it is turned off or the disk is known to differ
+        self.use_file_list = config.get("useTorrentFileList", True) and not read_disk
+        self.check_file_list = config.get("checkTorrentFileList", False)
         log.debug(f"{self.name} genre: {genre}")
 
     @staticmethod
@@ -51,65 +66,18 @@ class CompletedSeed:
         return time.time() - given_time_since_epoch
 
     @staticmethod
-    def delete_non_filetype_recursively(dir_path, keep_extensions: tuple):
-        """deletes all files that do not have matching extension(s)
-        Args:
-            dir_path: path to directory to delete files from
-            keep_extensions: tuple of file extensions including period ex: (".py", ".log")
-        Returns:
-            none
-        """
-        for root, dirs, files in os.walk(dir_path, topdown=False):
-            [
-                (Path(root, file).unlink(), log.debug(f"Deleted file: {file}"))
-                for file in files
-                if not file.endswith(keep_extensions)
-            ]
-
-    @staticmethod
-    def delete_empty_dirs_recursively(dir_path):
-        """deletes empty directories recursively
-        Args:
-            dir_path: top directory in tree
-        Returns:
-            none
-        """
-        for root, dirs, files in os.walk(dir_path, topdown=False):
-            [
-                (Path(root, dir).rmdir(), log.debug(f"Deleted empty directory: {dir}"))
-                for dir in dirs
-                if not any(Path(root, dir).iterdir())
-            ]
-
-    @staticmethod
-    def move_all_files_to_another_dir(source_dir: Path, dest_dir: Path):
-        """moves all files in directory tree to a directory in another tree
-        Args:
-            source_dir: path to directory to get files
-            dest_dir: path to directory to move files to
-        Returns:
-            none
-        """
-        for fs_obj in source_dir.rglob("*"):
-            if fs_obj.is_file():
-                new_path = Path(dest_dir, fs_obj.name)
-                if new_path.exists():
-                    log.info(
-                        f"Cannot move to {dest_dir}, because path already exists for: {fs_obj.name}"
-                    )
-                    continue
-                fs_obj.rename(new_path)
-
-    @staticmethod
-    def move_single_file(source, dest):
+    def move_single_file(source, dest, instance="default"):
         """moves single file from source to destination
         Args:
             source: source path
             dest: destination path
+            instance: name of the qbittorrent instance the download belongs to, for metrics
         Returns:
             None
         """
+        size = os.path.getsize(source)
         shutil.move(source, dest)
+        count_file("cleaner", "moved", size, instance)
         log.debug(f"Moved file: {source}")
 
     def delete_in_client(self):
@@ -125,9 +93,22 @@ class CompletedSeed:
             )
             log.debug(f"Added 'Processed' tag for {self.name}")
 
+    def file_list(self):
+        """gets the torrent's files from qbittorrent instead of reading the content tree
+        Returns:
+            list of (path, size) tuples, None to read the disk instead because the file list is turned off or was
+            checked against the disk and does not match it
+        """
+        if not self.use_file_list:
+            return None
+        return torrent_file_list(
+            self.qbitclient, self.hash, self.save_path, self.name, self.check_file_list
+        )
+
     def process_completed_seed(self, ignore_age):
         """performs class functions based on config.
-        ignores downloads older than specified time to avoid race conditions with periodic cleaner
+        ignores downloads older than specified time to avoid race conditions with periodic cleaner.
+        in a dry run the planned file operations are logged and nothing is changed
         Args:
             ignore_age: time in seconds since download completion to ignore
         Returns:
@@ -135,26 +116,43 @@ class CompletedSeed:
         """
         if self.time_complete < ignore_age:
             return
-        if self.file_exts_to_keep and self.content_path.is_dir():
-            self.delete_non_filetype_recursively(
-                self.content_path, self.file_exts_to_keep
-            )
-        if not self.keep_dir_structure:
-            if self.content_path.is_dir():
-                self.move_all_files_to_another_dir(self.content_path, self.save_path)
-                if not any(
-                    self.content_path.iterdir()
-                ):  # if content path is empty, delete it
-                    self.content_path.rmdir()
-                    log.debug(f"Deleted dir: {self.content_path}")
-            if self.content_path.is_file():
-                self.move_single_file(self.content_path, self.save_path)
+        files = None
+        if self.file_exts_to_keep or not self.keep_dir_structure:
+            files = self.file_list()
+        if files is None:
+            is_file = self.content_path.is_file()
+            is_dir = self.content_path.is_dir()
+        else:
+            is_file = [path for path, _ in files] == [str(self.content_path)]
+            is_dir = not is_file
+        if is_dir and (self.file_exts_to_keep or not self.keep_dir_structure):
+            flatten_to = None if self.keep_dir_structure else self.save_path
+            plan = FsPlan(self.content_path)
+            if files is None:
+                plan.scan(self.file_exts_to_keep, flatten_to)
+            else:
+                plan.plan_files(files, self.file_exts_to_keep, flatten_to)
+            if self.dry_run:
+                for line in plan.describe():
+                    log.info(f"Dry run for {self.name}: {line}")
+            else:
+                plan.execute(self.instance)
+        elif not self.keep_dir_structure and is_file:
+            if self.dry_run:
+                log.info(
+                    f"Dry run for {self.name}: move {self.content_path} -> {self.save_path}, "
+                    f"remove directory {self.content_path.parent}"
+                )
+            else:
+                self.move_single_file(self.content_path, self.save_path, self.instance)
                 self.content_path.parent.rmdir()
                 log.debug(f"Deleted dir for: {self.content_path}")
+        if self.dry_run:
+            return
         self.delete_in_client()  # this occurs always now. it should handle cases when not able to move files
-        if self.config["genres"][self.genre]["scriptOnDone"]:
+        if self.script_on_done:
             log.debug("Running subprocess for completed seed")
-            subprocess.run(self.config["genres"][self.genre]["scriptOnDone"])
+            subprocess.run(self.script_on_done)
 
         log.info(f"Processed completed seed: {self.name}")
 
@@ -164,61 +162,139 @@ class Cleaner:
     reviews completed seeds for post-processing steps and creates CompletedSeed objects
     """
 
-    def __init__(self, config, qbitclient):
+    def __init__(
+        self,
+        config,
+        qbitclient,
+        torrent_store,
+        genre_resolver,
+        journal,
+        device_limiter=None,
+    ):
         self.config = config
         self.qbitclient = qbitclient
+        self.torrent_store = torrent_store
+        self.genre_resolver = genre_resolver
+        self.journal = journal
+        self.seen_generation = 0
+        self.workers = config.get("cleanerWorkers", 1)
+        # shared between the cleaners of all qbittorrent instances so disks they have in common are throttled once
+        self.device_limiter = device_limiter or DeviceLimiter(
+            config.get("cleanerWorkersPerDevice", 1)
+        )
+        self.dry_run = config.get("cleanerDryRun", False)
 
     def get_completed_seeds(self):
-        """returns list of torrents that are done seeding
+        """yields torrents that are done seeding, paging through the torrent store
+        only torrents that changed since the last call or are still unfinished in the journal are considered
         Args:
             None
+        Yields:
+            completed seeds
+        """
+        changed, self.seen_generation = self.torrent_store.changed_since(
+            self.seen_generation
+        )
+        unfinished = self.journal.hashes("processed", PENDING, RUNNING, FAILED)
+        for i in self.torrent_store.iter_torrents(
+            status_filter="completed", torrent_hashes=changed | unfinished
+        ):
+            if (
+                i.state not in SEEDING_STATES
+                and "Processed" not in i.tags
+                and self.journal.state(i.hash, "processed") != DONE
+                and self.genre_resolver.resolve(i.save_path, i.category)
+            ):
+                yield i
+
+    def process_seed(self, seed, ignore_age):
+        """processes one seed while holding a slot on the devices its files live on.
+        errors are logged per seed so one failure does not stop the others. dry runs are not journaled
+        Args:
+            seed: CompletedSeed obj
+            ignore_age: time in seconds since download completion to ignore
         Returns:
-            list of completed seeds
+            None
         """
-        completed_list = self.qbitclient.torrents_info(status_filter="completed")
-        seeding_list = self.qbitclient.torrents_info(status_filter="seeding")
-        return [
-            i
-            for i in completed_list
-            if i not in seeding_list
-            and "Processed" not in i.tags
-            and self.get_genre(i.save_path, i.category)
-        ]
-
-    def get_genre(self, save_path, category: str):
-        """gets genre of torrent
-        first tries to match the torrent's category to a named genre
-        then tries to match based on save path
+        if self.dry_run:
+            with self.device_limiter.hold(seed.content_path, seed.save_path):
+                return seed.process_completed_seed(ignore_age)
+        self.journal.set(seed.hash, "processed", RUNNING)
+        try:
+            with self.device_limiter.hold(seed.content_path, seed.save_path):
+                seed.process_completed_seed(ignore_age)
+        except Exception as e:
+            self.journal.set(seed.hash, "processed", FAILED, str(e))
+            log.exception(f"Failed to process completed seed {seed.name}: {e}")
+        else:
+            self.journal.set(seed.hash, "processed", DONE)
 
+    def resume_interrupted(self):
+        """finishes seeds whose processing was cut off by a crash or restart, then forgets removed torrents
+        processing is safe to repeat: files already deleted or moved are skipped. the content tree is read from disk
+        for these, since the torrent's file list no longer matches it
+        """
+        interrupted = self.journal.hashes("processed", RUNNING)
+        for i in self.torrent_store.torrents_info(torrent_hashes=interrupted):
+            genre = self.genre_resolver.resolve(i.save_path, i.category)
+            if not genre:
+                continue
+            log.info(f"Resuming interrupted processing of: {i.name}")
+            self.process_seed(
+                CompletedSeed(
+                    self.config,
+                    self.qbitclient,
+                    i.name,
+                    i.hash,
+                    i.content_path,
+                    i.save_path,
+                    i.completion_on,
+                    genre,
+                    self.dry_run,
+                    read_disk=True,
+                ),
+                0,
+            )
+        self.journal.forget(self.torrent_store.torrents)
+
+    def clean_seeds(self, ignore_age=120, ready_hashes=frozenset()):
+        """creates objects and tells them to process themselves, in a worker pool if cleanerWorkers > 1
+        seeds are processed as the torrent store is paged through, not once every completed seed is listed
         Args:
-            save_path: torrent save_path
+            ignore_age: time in seconds since download completion to ignore
+            ready_hashes: hashes qbittorrent reported as complete, these are not held back by ignore_age
         Returns:
-            genre from config or False
+            None
         """
-        genre_path = Path(save_path).parent
-        for key, val in self.config["genres"].items():
-            if key == category:
-                return key
-        for key, val in self.config["genres"].items():
-            if Path(val["moveToDir"]) == genre_path:
-                return key
-        return False
-
-    def clean_seeds(self, ignore_age=120):
-        """creates objects and tells them to process themselves"""
-        if not self.get_completed_seeds():
-            return log.debug("No completed seeds to clean")
-        for i in [
-            CompletedSeed(
-                self.config,
-                self.qbitclient,
-                i.name,
-                i.hash,
-                i.content_path,
-                i.save_path,
-                i.completion_on,
-                self.get_genre(i.save_path, i.category),
+        pool = None
+        if self.workers > 1:
+            pool = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="cleaner"
             )
-            for i in self.get_completed_seeds()
-        ]:
-            i.process_completed_seed(ignore_age)
+        found = 0
+        try:
+            for i in self.get_completed_seeds():
+                found += 1
+                seed = CompletedSeed(
+                    self.config,
+                    self.qbitclient,
+                    i.name,
+                    i.hash,
+                    i.content_path,
+                    i.save_path,
+                    i.completion_on,
+                    self.genre_resolver.resolve(i.save_path, i.category),
+                    self.dry_run,
+                )
+                if seed.hash not in ready_hashes and seed.time_complete < ignore_age:
+                    if not self.dry_run:
+                        self.journal.set(seed.hash, "processed", PENDING)
+                elif pool is None:
+                    self.process_seed(seed, 0)
+                else:
+                    pool.submit(self.process_seed, seed, 0)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        if not found:
+            log.debug("No completed seeds to clean")
@@ -0,0 +1,328 @@
+import logging
+import re
+from queue import Queue
+from types import SimpleNamespace
+
+from utils.add_cat import AddCategory
+from utils.add_rule import RSSRule
+from utils.cleaner import Cleaner
+from utils.device_limits import DeviceLimiter
+from utils.importer import Importer
+from utils.instances import Instance
+from utils.plex_scanner import PlexScanner, ScanCoordinator
+from utils.scheduler import Scheduler
+from utils.set_limits import ShareLimiter
+
+log = logging.getLogger(__name__)
+
+
+def limits_task(tasks):
+    share_limiter = tasks.share_limiter
+    tasks.instance.torrent_store.sync()
+    share_limiter.set_limits()
+
+
+def cleaner_task(tasks, ignore_age: int):
+    """cleans seeds, without holding back those reported complete through 'notify'"""
+    cleaner = tasks.cleaner
+    ready_hashes = set()
+    while not tasks.notify_queue.empty():
+        ready_hashes.add(tasks.notify_queue.get_nowait())
+    tasks.instance.torrent_store.sync()
+    cleaner.clean_seeds(ignore_age, ready_hashes)
+
+
+def plex_task(tasks):
+    plex_scanner = tasks.plex_scanner
+    tasks.instance.torrent_store.sync()
+    plex_scanner.scan_if_needed()
+
+
+def notify_handler(scheduler: Scheduler, notify_queues: list):
+    """control socket handler that queues a notified torrent hash for every instance and runs all tasks now"""
+
+    def handle(request):
+        torrent_hash = str(request.get("hash", "")).lower()
+        if not re.fullmatch(r"[0-9a-f]{40}|[0-9a-f]{64}", torrent_hash):
+            return {"ok": False, "error": f"Not a torrent hash: {torrent_hash!r}"}
+        for notify_queue in notify_queues:
+            notify_queue.put(torrent_hash)
+        for name in scheduler.tasks:
+            scheduler.run_now(name)
+        return {"ok": True}
+
+    return handle
+
+
+class InstanceTasks:
+    """
+    the share limiter, cleaner and plex scanner the daemon runs for a qbittorrent instance.
+    reload() builds them again from a new config. each tick picks them up when it starts, so a tick that is running
+    finishes with the ones it started with and the next one uses the new ones
+    """
+
+    # settings only read when the daemon starts
+    RESTART_KEYS = (
+        "host",
+        "username",
+        "password",
+        "journalFile",
+        "asyncMode",
+        "apiMaxInFlight",
+        "apiTimeout",
+        "apiRetries",
+        # the device limiter is shared by the cleaners of every instance
+        "cleanerWorkersPerDevice",
+    )
+
+    def __init__(
+        self,
+        scheduler: Scheduler,
+        instance: Instance,
+        prefix: str,
+        device_limiter: DeviceLimiter,
+    ):
+        self.scheduler = scheduler
+        self.instance = instance
+        self.prefix = prefix
+        self.device_limiter = device_limiter
+        # per instance, so plex settings in an [[instances]] entry apply to that instance's scans
+        self.scan_coordinator = ScanCoordinator(instance.config)
+        self.notify_queue = Queue()  # hashes notified complete
+        self.share_limiter = None
+        self.cleaner = None
+        self.plex_scanner = None
+        self.build()
+
+    def build(self):
+        instance = self.instance
+        config = instance.config
+        share_limiter = ShareLimiter(
+            config, instance.qbitclient, instance.torrent_store, instance.api
+        )
+        if self.share_limiter:
+            # tracker urls do not depend on config
+            share_limiter.tracker_cache = self.share_limiter.tracker_cache
+            if share_limiter.queue_optimizer and self.share_limiter.queue_optimizer:
+                # so a reload does not reshuffle the queue
+                share_limiter.queue_optimizer.held_scores = (
+                    self.share_limiter.queue_optimizer.held_scores
+                )
+        cleaner = Cleaner(
+            config,
+            instance.qbitclient,
+            instance.torrent_store,
+            instance.genre_resolver,
+            instance.journal,
+            self.device_limiter,
+        )
+        plex_scanner = PlexScanner(
+            config,
+            instance.qbitclient,
+            instance.torrent_store,
+            instance.genre_resolver,
+            instance.journal,
+            self.scan_coordinator,
+        )
+        self.share_limiter, self.cleaner, self.plex_scanner = (
+            share_limiter,
+            cleaner,
+            plex_scanner,
+        )
+
+    def intervals(self):
+        """task name -> seconds between runs"""
+        config = self.instance.config
+        return {
+            f"{self.prefix}limits": config["checkInterval"] * 60,
+            f"{self.prefix}cleaner": config.get(
+                "cleanerInterval", config["checkInterval"]
+            )
+            * 60,
+            f"{self.prefix}plex": config.get("plexInterval", config["checkInterval"])
+            * 60,
+        }
+
+    def schedule(self):
+        """resumes interrupted work and schedules the tasks
+        an instance that cannot be reached at start is still scheduled, its tasks fail and retry on their own
+        """
+        try:
+            self.instance.torrent_store.sync()
+            self.cleaner.resume_interrupted()
+        except Exception as e:
+            log.exception(
+                f"Could not resume qbittorrent instance {self.instance.name}: {e}"
+            )
+        jitter = self.instance.config.get("schedulerJitter", 0)
+        intervals = self.intervals()
+        self.scheduler.add(
+            f"{self.prefix}limits",
+            intervals[f"{self.prefix}limits"],
+            limits_task,
+            self,
+            jitter=jitter,
+        )
+        self.scheduler.add(
+            f"{self.prefix}cleaner",
+            intervals[f"{self.prefix}cleaner"],
+            cleaner_task,
+            self,
+            20,
+            jitter=jitter,
+        )
+        self.scheduler.add(
+            f"{self.prefix}plex",
+            intervals[f"{self.prefix}plex"],
+            plex_task,
+            self,
+            jitter=jitter,
+        )
+
+    def reload(self, config):
+        """switches the instance to a new config and rebuilds its tasks' objects
+        Args:
+            config: Config obj for the instance
+        """
+        changed = [
+            key
+            for key in self.RESTART_KEYS
+            if config.get(key) != self.instance.config.get(key)
+        ]
+        if changed:
+            log.warning(
+                f"Restart qbitmgr to apply {', '.join(changed)} for qbittorrent instance {self.instance.name}"
+            )
+        self.instance.reload(config)
+        self.scan_coordinator.configure(config)
+        self.build()
+        for name, interval in self.intervals().items():
+            self.scheduler.set_interval(name, interval)
+
+
+def reload_handler(instance_tasks: list):
+    """ConfigWatcher callback that gives every scheduled instance its new config
+    Args:
+        instance_tasks: list of InstanceTasks objs
+    """
+
+    def reload(configs):
+        for tasks in instance_tasks:
+            if tasks.instance.name in configs:
+                tasks.reload(configs[tasks.instance.name])
+            else:
+                log.warning(
+                    f"qbittorrent instance {tasks.instance.name} is no longer in config, restart qbitmgr to stop it"
+                )
+        added = configs.keys() - {tasks.instance.name for tasks in instance_tasks}
+        if added:
+            log.warning(
+                f"Restart qbitmgr to start managing qbittorrent instances {sorted(added)}"
+            )
+
+    return reload
+
+
+def add_rule(instance: Instance, args):
+    log.debug("User call to: add new RSS auto downloading rule")
+    category = AddCategory(instance.config, instance.qbitclient, args.name, args.genre)
+    category.add_category()
+    rule = RSSRule(instance.config, instance.qbitclient, args.name, args.genre)
+    rule.add_rule()
+
+
+def add_cat(instance: Instance, args):
+    log.debug("User call to: add new category")
+    category = AddCategory(instance.config, instance.qbitclient, args.name, args.genre)
+    category.add_category()
+
+
+def import_names(instance: Instance, args):
+    log.debug("User call to: import categories and rules")
+    importer = Importer(
+        instance.config, instance.qbitclient, instance.api, args.dry_run
+    )
+    plan = importer.run(args.entries)
+    return Importer.summary(plan, args.dry_run)
+
+
+def clean(instance: Instance, args):
+    log.debug("User call to: clean seeds")
+    config = instance.config
+    if args.dry_run:
+        config = config.updated(cleanerDryRun=True)
+    instance.torrent_store.sync()
+    cleaner = Cleaner(
+        config,
+        instance.qbitclient,
+        instance.torrent_store,
+        instance.genre_resolver,
+        instance.journal,
+    )
+    cleaner.clean_seeds(10)
+
+
+def set_limits(instance: Instance, args):
+    log.debug("User call to: set limits")
+    instance.torrent_store.sync()
+    share_limiter = ShareLimiter(
+        instance.config, instance.qbitclient, instance.torrent_store, instance.api
+    )
+    share_limiter.set_limits()
+
+
+# commands run by a handler given an Instance and the cli args, returning a summary to print or None
+COMMANDS = {
+    "add-rule": add_rule,
+    "add-cat": add_cat,
+    "import": import_names,
+    "clean": clean,
+    "set-limits": set_limits,
+}
+
+
+# commands the run daemon carries out by running its own scheduled task, by task name without the instance prefix
+TASK_COMMANDS = {"clean": "cleaner", "set-limits": "limits"}
+
+
+def command_handler(scheduler: Scheduler, instances: list, prefixes: dict):
+    """control socket handler that runs a cli command on the daemon's logged in instances
+    'clean' and 'set-limits' run the daemon's own task now and wait for it, so they never overlap a scheduled run
+    Args:
+        scheduler: Scheduler obj with the instances' tasks
+        instances: list of Instance objs
+        prefixes: dict of instance name -> prefix of its task names
+    """
+
+    def handle(request):
+        args = SimpleNamespace(**request.get("args", {}))
+        selected = [
+            instance
+            for instance in instances
+            if not args.instance or instance.name == args.instance
+        ]
+        if not selected or args.cmd not in COMMANDS:
+            return {
+                "ok": False,
+                "error": f"Cannot run {args.cmd} on qbittorrent instance {args.instance!r}",
+            }
+        results = {}
+        errors = {}
+        for instance in selected:
+            try:
+                if args.cmd in TASK_COMMANDS:
+                    name = f"{prefixes[instance.name]}{TASK_COMMANDS[args.cmd]}"
+                    scheduler.run_now(name, wait=True)
+                    if scheduler.tasks[name].error:
+                        raise scheduler.tasks[name].error
+                    results[instance.name] = None
+                else:
+                    results[instance.name] = COMMANDS[args.cmd](instance, args)
+            except Exception as e:
+                log.exception(
+                    f"{args.cmd} failed for qbittorrent instance {instance.name}: {e}"
+                )
+                errors[instance.name] = str(e)
+        return {"ok": not errors, "results": results, "errors": errors}
+
+    return handle
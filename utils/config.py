@@ -0,0 +1,338 @@
+import logging
+import os
+from collections.abc import Mapping
+from types import MappingProxyType
+
+import toml
+
+log = logging.getLogger(__name__)
+
+
+class ConfigError(ValueError):
+    """config.toml is missing settings or has settings of the wrong type"""
+
+
+class Record:
+    """read-only record with __slots__, every field given once to the constructor"""
+
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, i) == getattr(other, i) for i in self.__slots__
+        )
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, i) for i in self.__slots__))
+
+    def __repr__(self):
+        fields = ", ".join(f"{i}={getattr(self, i)!r}" for i in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class ShareGroup(Record):
+    """a [shareLimits] group"""
+
+    __slots__ = (
+        "name",
+        "trackers",
+        "categories",
+        "ratio_limit",
+        "seeding_time_limit",
+        "upload_speed_limit",
+        "tags",
+        "tag_names",
+        "priority_in_queue",
+        "weight",
+    )
+
+    @classmethod
+    def from_config(cls, name, val):
+        return cls(
+            name=name,
+            trackers=tuple(val["trackers"]),
+            categories=tuple(val["categories"]),
+            ratio_limit=val["ratio_limit"],
+            seeding_time_limit=val["seeding_time_limit"],
+            upload_speed_limit=val["upload_speed_limit"],
+            tags=val["tags"],
+            tag_names=tuple(i.strip() for i in val["tags"].split(",") if i.strip()),
+            priority_in_queue=val["priorityInQueue"],
+            weight=val.get("weight", 1),
+        )
+
+
+class RSSTemplate(Record):
+    """the [genres.<genre>.rssRules] template new RSS auto download rules are made from"""
+
+    __slots__ = ("fields", "replace_separators")
+
+    # rssRules key -> default for keys that may be left out
+    DEFAULTS = {
+        "enabled": True,
+        "mustContain": "",
+        "mustNotContain": "",
+        "useRegex": False,
+        "episodeFilter": "",
+        "smartFilter": False,
+        "previouslyMatchedEpisodes": "",
+        "affectedFeeds": [],
+        "ignoreDays": 0,
+        "lastMatch": "",
+        "addPaused": False,
+        "savePath": "",
+    }
+
+    @classmethod
+    def from_config(cls, val, replace_separators):
+        return cls(
+            fields=tuple(
+                (
+                    key,
+                    (
+                        tuple(val.get(key, default))
+                        if key == "affectedFeeds"
+                        else val.get(key, default)
+                    ),
+                )
+                for key, default in cls.DEFAULTS.items()
+            ),
+            replace_separators=replace_separators,
+        )
+
+    def rule(self, name, genre):
+        """builds a rule for a name
+        Returns:
+            tuple of (rule name, rule definition dict for qbittorrent)
+        """
+        definition = dict(self.fields)
+        definition["affectedFeeds"] = list(definition["affectedFeeds"])
+        definition["mustContain"] = f"{name} {definition['mustContain']}"
+        if self.replace_separators:
+            new_name = (
+                self.replace_separators.join(name.split()) + self.replace_separators
+            )
+            definition["mustContain"] = rf"\b{new_name}"
+        definition["assignedCategory"] = f"{genre.upper()} - {name}"
+        return f"{genre.upper()} - {name}", definition
+
+
+class Genre(Record):
+    """a [genres] entry"""
+
+    __slots__ = (
+        "name",
+        "move_to_dir",
+        "keep_dir_structure",
+        "keep_extensions",
+        "delete_from_client",
+        "scan_plex",
+        "script_on_done",
+        "rss",
+    )
+
+    @classmethod
+    def from_config(cls, name, val):
+        return cls(
+            name=name,
+            move_to_dir=os.path.normpath(val["moveToDir"]) if val["moveToDir"] else "",
+            keep_dir_structure=val["keepDirStructure"],
+            keep_extensions=tuple(val["keepSpecificFileTypes"]),
+            delete_from_client=val["deleteFromClientWhenDone"],
+            scan_plex=val["scanPlex"],
+            script_on_done=val.get("scriptOnDone", ""),
+            rss=(
+                RSSTemplate.from_config(
+                    val["rssRules"], val.get("regexReplaceSeparators", "")
+                )
+                if "rssRules" in val
+                else None
+            ),
+        )
+
+
+# key -> expected type, for settings every config needs
+REQUIRED = {"logLevel": str, "checkInterval": (int, float)}
+SHARE_GROUP_KEYS = {
+    "priorityInQueue": bool,
+    "trackers": list,
+    "categories": list,
+    "ratio_limit": (int, float),
+    "seeding_time_limit": int,
+    "upload_speed_limit": int,
+    "tags": str,
+}
+GENRE_KEYS = {
+    "moveToDir": str,
+    "keepDirStructure": bool,
+    "keepSpecificFileTypes": list,
+    "deleteFromClientWhenDone": bool,
+    "scanPlex": bool,
+}
+
+
+def check_keys(table, keys, where):
+    """lists the keys of a table that are missing or have the wrong type"""
+    problems = []
+    for key, type_ in keys.items():
+        if key not in table:
+            problems.append(f"{where}: missing '{key}'")
+        elif not isinstance(table[key], type_) or (
+            type_ is not bool and isinstance(table[key], bool)
+        ):
+            problems.append(f"{where}: '{key}' has the wrong type")
+    return problems
+
+
+def validate(raw):
+    """checks a config dict
+    Raises:
+        ConfigError listing every problem found
+    """
+    problems = check_keys(raw, REQUIRED, "config")
+    if isinstance(raw.get("checkInterval"), (int, float)) and raw["checkInterval"] <= 0:
+        problems.append("config: 'checkInterval' must be more than 0")
+    share_limits = raw.get("shareLimits", {})
+    if not isinstance(share_limits, dict):
+        problems.append("shareLimits: must be a table of groups")
+        share_limits = {}
+    if "default" not in share_limits:
+        problems.append("shareLimits: missing the 'default' group")
+    for name, val in share_limits.items():
+        if not isinstance(val, dict):
+            problems.append(f"shareLimits.{name}: must be a table")
+            continue
+        problems.extend(check_keys(val, SHARE_GROUP_KEYS, f"shareLimits.{name}"))
+        weight = val.get("weight", 1)
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            problems.append(f"shareLimits.{name}: 'weight' must be more than 0")
+    genres = raw.get("genres", {})
+    if not isinstance(genres, dict):
+        problems.append("genres: must be a table of genres")
+        genres = {}
+    if not genres:
+        problems.append("genres: no genres configured")
+    for name, val in genres.items():
+        if not isinstance(val, dict):
+            problems.append(f"genres.{name}: must be a table")
+            continue
+        problems.extend(check_keys(val, GENRE_KEYS, f"genres.{name}"))
+        if any(
+            not isinstance(i, str) or not i.startswith(".")
+            for i in val.get("keepSpecificFileTypes", [])
+        ):
+            problems.append(
+                f"genres.{name}: 'keepSpecificFileTypes' must be extensions starting with a period"
+            )
+        if "rssRules" in val and not isinstance(val["rssRules"], dict):
+            problems.append(f"genres.{name}.rssRules: must be a table")
+        elif "rssRules" in val and not isinstance(
+            val["rssRules"].get("affectedFeeds", []), list
+        ):
+            problems.append(f"genres.{name}.rssRules: 'affectedFeeds' must be a list")
+    page_size = raw.get("listPageSize", 0)
+    if not isinstance(page_size, int) or isinstance(page_size, bool) or page_size < 0:
+        problems.append("config: 'listPageSize' must be an integer of 0 or more")
+    if not isinstance(raw.get("listSortKey", ""), str):
+        problems.append("config: 'listSortKey' must be a string")
+    for key in ("useTorrentFileList", "checkTorrentFileList"):
+        if not isinstance(raw.get(key, False), bool):
+            problems.append(f"config: '{key}' must be true or false")
+    allocator = raw.get("uploadAllocator", {})
+    if not isinstance(allocator, dict):
+        problems.append("uploadAllocator: must be a table")
+    elif allocator.get("enabled") and not isinstance(
+        allocator.get("globalUploadLimit"), int
+    ):
+        problems.append("uploadAllocator: 'globalUploadLimit' must be an integer")
+    if problems:
+        raise ConfigError("Invalid config: " + "; ".join(problems))
+
+
+def read_only(value):
+    """a read-only copy of a config value: tables become mappingproxies and lists tuples, all the way down"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: read_only(val) for key, val in value.items()})
+    if isinstance(value, list):
+        return tuple(read_only(i) for i in value)
+    return value
+
+
+class Config(Mapping):
+    """
+    config validated and compiled once. reads like a read-only copy of the dict it was built from, and share limit
+    groups and genres are also available as records in share_groups and genres, in config order
+    """
+
+    def __init__(self, raw):
+        validate(raw)
+        self._raw = raw
+        self._view = read_only(raw)
+        self.share_groups = {
+            name: ShareGroup.from_config(name, val)
+            for name, val in raw["shareLimits"].items()
+        }
+        self.genres = {
+            name: Genre.from_config(name, val) for name, val in raw["genres"].items()
+        }
+
+    def __getitem__(self, key):
+        return self._view[key]
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def updated(self, **changes):
+        """a new Config with some top level settings changed"""
+        return Config({**self._raw, **changes})
+
+
+class ConfigWatcher:
+    """
+    polls config.toml's modification time and hands a freshly loaded config to on_change when it changes.
+    a config that fails to load is logged and skipped, and the one in use stays until the file changes again
+    """
+
+    def __init__(self, path, load, on_change):
+        """
+        Args:
+            path: path of config.toml
+            load: function taking the parsed toml dict and returning what on_change gets. may raise ConfigError
+            on_change: function called with the loaded config
+        """
+        self.path = path
+        self.load = load
+        self.on_change = on_change
+        self.mtime = self.modified()
+
+    def modified(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self):
+        mtime = self.modified()
+        if mtime is None or mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            config = self.load(toml.load(self.path))
+        except (ConfigError, toml.TomlDecodeError, OSError) as e:
+            log.error(f"Keeping the config in use, could not load {self.path}: {e}")
+            return
+        log.info(f"Reloading {self.path}")
+        self.on_change(config)
@@ -0,0 +1,98 @@
+import errno
+import json
+import logging
+import os
+import socket
+from threading import Thread
+
+log = logging.getLogger(__name__)
+
+
+class ControlServer:
+    """
+    unix domain socket the run daemon listens on for commands from other processes
+    requests and responses are single lines of json. handlers map a request's 'cmd' to a function
+    that takes the request dict and returns a response dict
+    """
+
+    def __init__(self, path, handlers):
+        self.path = str(path)
+        self.handlers = handlers
+        self._server = None
+
+    def start(self):
+        """binds the socket and serves requests in a background thread
+        Raises:
+            OSError if another daemon is already listening on the socket
+        """
+        # imported here so commands that only send a request start quickly
+        import socketserver
+
+        if os.path.exists(self.path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(self.path)
+                except ConnectionRefusedError:
+                    # left behind by a daemon that did not shut down cleanly
+                    os.unlink(self.path)
+                else:
+                    raise OSError(
+                        errno.EADDRINUSE,
+                        "Another qbitmgr daemon is listening on the control socket",
+                        self.path,
+                    )
+        control = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.wfile.write(
+                    json.dumps(control.dispatch(self.rfile.readline())).encode() + b"\n"
+                )
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, RequestHandler)
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, name="control", daemon=True).start()
+        log.info(f"Listening for commands on {self.path}")
+
+    def dispatch(self, line):
+        """runs the handler for one request line
+        Args:
+            line: bytes of a json request
+        Returns:
+            response dict
+        """
+        try:
+            request = json.loads(line)
+            handler = self.handlers[request["cmd"]]
+        except (ValueError, KeyError, TypeError):
+            return {"ok": False, "error": f"Invalid request: {line[:200]!r}"}
+        try:
+            return handler(request)
+        except Exception as e:
+            log.exception(f"Control command {request['cmd']} failed: {e}")
+            return {"ok": False, "error": str(e)}
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            os.unlink(self.path)
+
+
+def send_command(path, request, timeout=5):
+    """sends a request to a running daemon
+    Args:
+        path: path of the daemon's control socket
+        request: dict with a 'cmd' key
+        timeout: seconds to wait for a response
+    Returns:
+        response dict
+    Raises:
+        OSError if no daemon is listening
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as response:
+            return json.loads(response.readline())
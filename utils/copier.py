@@ -2,41 +2,53 @@ import glob
 import logging
 import os
 import shutil
-import subprocess
-import time
 from fnmatch import filter
 from typing import Tuple
 
+from utils.fastcopy import link_or_copy, same_device
+from utils.fs_plan import torrent_file_list
+from utils.journal import DONE, FAILED, RUNNING
+from utils.metrics import count_file
+from utils.torrent_store import DEFAULT_PAGE_SIZE, DEFAULT_SORT, paged_torrents_info
+from utils.verify import PieceVerifier
+
 log = logging.getLogger(__name__)
 
 
 class CompletedDownload:
-    def __init__(self, config, name, hash, content_path, save_path, category):
+    def __init__(self, config, name, hash, content_path, save_path, category, genre):
         self.config = config
+        self.instance = config.get("name", "default")
         self.name = name
         self.hash = hash
         self.content_path = content_path
         self.save_path = os.path.normpath(save_path)  # path to category
         self.category = category
-        self.genre = os.path.basename(
-            os.path.dirname(self.save_path)
-        )  # returns one directory up from given directory
-        self.destination_dir = os.path.join(
-            self.config["genres"][self.genre]["moveToDir"], self.category
-        )
-        self.keep_dir_structure = self.config["genres"][self.genre]["keepDirStructure"]
-        self.file_exts_to_keep = (
-            ("*")
-            if not self.config["genres"][self.genre]["keepSpecificFileTypes"]
-            else tuple(self.config["genres"][self.genre]["keepSpecificFileTypes"])
-        )
-        self.scan_plex = self.config["genres"][self.genre]["scanPlex"]
-        self.plex_command = self.config["plexScanCommand"]
+        self.genre = genre
+        genre_config = config.genres[genre]
+        self.library_dir = genre_config.move_to_dir
+        self.destination_dir = os.path.join(self.library_dir, self.category)
+        self.keep_dir_structure = genre_config.keep_dir_structure
+        self.keep_extensions = genre_config.keep_extensions
+        # glob patterns for the extensions, when the disk is read instead of the torrent's file list
+        self.file_exts_to_keep = tuple(f"*{i}" for i in self.keep_extensions) or ("*",)
+        self.scan_plex = genre_config.scan_plex
         self.files_to_copy = []
         self.copied_paths = []
+        self.copied_files = {}  # source file -> destination file
+        # files_to_copy came from the torrent's file list, not the disk
+        self.from_file_list = False
+
+    def in_library(self):
+        """whether the download was saved inside the genre's moveToDir already, where copying it would only link it
+        onto itself or into a sibling category directory
+        """
+        return (
+            os.path.commonpath([self.save_path, self.library_dir]) == self.library_dir
+        )
 
     def list_files_with_exts(self):
-        """gets list of files that have the extensions specified - defaults to all if file_exts_to_keep is ('*')"""
+        """gets list of files that have the extensions specified - defaults to all if file_exts_to_keep is ('*',)"""
         files = []
         if os.path.isfile(self.content_path):
             extensions_mod = tuple(i.replace("*", "") for i in self.file_exts_to_keep)
@@ -52,17 +64,55 @@ class CompletedDownload:
             )
         return self.files_to_copy.extend(files)
 
+    def list_files_from_torrent(self, files):
+        """gets the files that have the extensions specified from the torrent's file list, without reading the disk
+        Args:
+            files: list of (path, size) tuples of the torrent's files
+        """
+        self.from_file_list = True
+        self.files_to_copy.extend(
+            path
+            for path, _ in files
+            if not self.keep_extensions or path.endswith(self.keep_extensions)
+        )
+
+    def link_or_copy_listed_tree(self):
+        """links or copies files_to_copy to the same paths under destination_dir as they have under save_path,
+        making only the directories they go in, so no empty directories are left to clean up
+        """
+        link = None
+        for source in self.files_to_copy:
+            destination_path = os.path.join(
+                self.destination_dir, os.path.relpath(source, self.save_path)
+            )
+            try:
+                os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+                if link is None:
+                    link = same_device(source, self.destination_dir)
+                method = link_or_copy(source, destination_path, link=link)
+            except OSError as e:
+                log.error(f"Failed to copy {source} to {destination_path}: {e}")
+                continue
+            log.debug(f"{method} {source} to {destination_path}")
+            count_file(
+                "copier", method, os.path.getsize(destination_path), self.instance
+            )
+            self.copied_files[source] = destination_path
+            self.copied_paths.append(destination_path)
+
     def link_or_copy_file(self, source, destination_dir):
         file_name = os.path.basename(source)
         destination_path = os.path.join(destination_dir, file_name)
         try:
-            os.link(source, destination_path)
-            log.debug(f"Hard linked {file_name} to {destination_dir}")
-        except:
-            shutil.copy2(source, destination_path)
-            log.debug(f"Hard link failed, copied {file_name} to {destination_dir}")
-        finally:
-            return self.copied_paths.append(destination_path)
+            method = link_or_copy(
+                source, destination_path, link=same_device(source, destination_dir)
+            )
+        except OSError as e:
+            return log.error(f"Failed to copy {file_name} to {destination_dir}: {e}")
+        log.debug(f"{method} {file_name} to {destination_dir}")
+        count_file("copier", method, os.path.getsize(destination_path), self.instance)
+        self.copied_files[source] = destination_path
+        return self.copied_paths.append(destination_path)
 
     def copy_files_only(self):
         os.makedirs(self.destination_dir, exist_ok=True)
@@ -88,27 +138,37 @@ class CompletedDownload:
         return _ignore_patterns
 
     def link_or_copy_tree(self, source, destination_dir):
+        """links or copies a directory tree in one pass.
+        whether hard links are possible is decided once up front from the devices of source and destination
+        """
         dir_name = os.path.basename(source)
         destination_path = os.path.join(destination_dir, dir_name)
+        link = same_device(source, destination_dir)
+
+        def copy_function(src, dst):
+            method = link_or_copy(src, dst, link=link)
+            count_file("copier", method, os.path.getsize(dst), self.instance)
+            self.copied_files[src] = dst
+            self.copied_paths.append(dst)
+
         try:
             shutil.copytree(
                 source,
                 destination_path,
                 ignore=self.include_patterns(self.file_exts_to_keep),
-                copy_function=os.link,
+                copy_function=copy_function,
+                dirs_exist_ok=True,
             )
-            log.debug(f"Hard linked {dir_name} to {destination_dir}")
-        except:
-            shutil.copytree(
-                source,
-                destination_path,
-                ignore=self.include_patterns(self.file_exts_to_keep),
+        except (OSError, shutil.Error) as e:
+            log.error(f"Failed to copy {dir_name} to {destination_dir}: {e}")
+        else:
+            log.debug(
+                f"{'Hard linked' if link else 'Copied'} {dir_name} to {destination_dir}"
             )
-            log.debug(f"Hard link failed, copied {dir_name} to {destination_dir}")
-        finally:
-            return self.copied_paths.append(destination_path)
 
     def copy_subtree(self):
+        if self.from_file_list:
+            return self.link_or_copy_listed_tree()
         if not os.path.isfile(self.content_path):
             log.debug("Content path is not file, copying tree")
             return self.link_or_copy_tree(self.content_path, self.destination_dir)
@@ -131,14 +191,6 @@ class CompletedDownload:
             fsobject = os.path.dirname(fsobject)
         return fsobject
 
-    def plex_scan(self):
-        time.sleep(5)
-        s = subprocess.check_output(self.plex_command).strip().decode("UTF-8")
-        if "Got nothing for: It's All Connected" in s:
-            log.info(f"Plex scan succes, stdout: '{s}'")
-        else:
-            log.info(f"Plex scan failed, stdout: '{s}'")
-
     def check_copy_completed(self):
         files_to_copy_count = len(self.files_to_copy)
         copied_paths_count = len(self.copied_paths)
@@ -155,6 +207,37 @@ class CompletedDownload:
             return False
         return True
 
+    def verify_copies(self, qbitclient, workers, api=None):
+        """checks copied files against the torrent's piece hashes and re-copies files that fail once
+        Args:
+            qbitclient: qbittorrentapi client
+            workers: number of pieces to hash at the same time
+            api: SerialClient or AsyncClient to fetch the piece hashes and file layout with
+        Returns:
+            True if every verifiable file matches its pieces
+        """
+        verifier = PieceVerifier(qbitclient, self.hash, workers, api)
+        if not verifier.load():
+            log.info(f"No v1 piece hashes to verify copies of {self.name}")
+            return True
+        destinations = {
+            os.path.relpath(source, self.save_path): destination
+            for source, destination in self.copied_files.items()
+        }
+        failed = verifier.verify(destinations)
+        if not failed:
+            return True
+        for name in failed:
+            log.info(f"Copy failed verification, copying again: {name}")
+            os.unlink(destinations[name])
+            link_or_copy(
+                os.path.join(self.save_path, name), destinations[name], link=False
+            )
+        failed = verifier.verify({name: destinations[name] for name in failed})
+        for name in failed:
+            log.error(f"Copy failed verification twice: {name}")
+        return not failed
+
     def delete_empty_dirs_recursively(self, path):
         for item in glob.iglob(os.path.join(path, "**"), recursive=True):
             if not os.path.exists(item) or not os.path.isdir(item) or os.listdir(item):
@@ -164,50 +247,97 @@ class CompletedDownload:
 
 
 class Copier:
-    def __init__(self, config, qbitclient):
+    def __init__(
+        self, config, qbitclient, genre_resolver, journal, scan_coordinator, api=None
+    ):
         self.config = config
         self.qbitclient = qbitclient
+        self.api = api
+        self.genre_resolver = genre_resolver
+        self.journal = journal
+        self.scan_coordinator = scan_coordinator
         self.to_copy = self.identify_completes_to_copy()
 
     def identify_completes_to_copy(self):
-        completed_torrents = [
-            i
-            for i in self.qbitclient.torrents_info(status_filter="completed")
-            if "Copied" not in i.tags
-        ]
-        completed_objs = [
-            CompletedDownload(
-                self.config, i.name, i.hash, i.content_path, i.save_path, i.category
-            )
-            for i in completed_torrents
-        ]
-        return [
-            i
-            for i in completed_objs
-            if i.genre in list(self.config["genres"])
-            and self.config["genres"][i.genre]["moveToDir"]
-        ]
+        """yields downloads to copy, requesting completed torrents a page at a time as they are needed"""
+        for page in paged_torrents_info(
+            self.qbitclient,
+            "completed",
+            self.config.get("listPageSize", DEFAULT_PAGE_SIZE),
+            self.config.get("listSortKey", DEFAULT_SORT),
+        ):
+            for i in page:
+                if "Copied" in i.tags or self.journal.state(i.hash, "copied") == DONE:
+                    continue
+                genre = self.genre_resolver.resolve(i.save_path, i.category)
+                if not genre or not self.config.genres[genre].move_to_dir:
+                    continue
+                download = CompletedDownload(
+                    self.config,
+                    i.name,
+                    i.hash,
+                    i.content_path,
+                    i.save_path,
+                    i.category,
+                    genre,
+                )
+                if download.in_library():
+                    log.debug(f"Completed download is already in its library: {i.name}")
+                    continue
+                yield download
+
+    def file_list(self, download):
+        """gets a download's files from qbittorrent instead of reading the content tree
+        Returns:
+            list of (path, size) tuples, None to read the disk instead because the file list is turned off or was
+            checked against the disk and does not match it
+        """
+        if not self.config.get("useTorrentFileList", True):
+            return None
+        return torrent_file_list(
+            self.qbitclient,
+            download.hash,
+            download.save_path,
+            download.name,
+            self.config.get("checkTorrentFileList", False),
+        )
 
     def copy_completes(self):
-        if not self.to_copy:
-            log.info("No completed downloads to copy")
-            return
+        found = 0
         for i in self.to_copy:
-            i.list_files_with_exts()
+            found += 1
+            files = self.file_list(i)
+            if files is None:
+                i.list_files_with_exts()
+            else:
+                i.list_files_from_torrent(files)
             if not i.files_to_copy:
                 log.info(
                     f"Completed download had no files with correct extension(s) to copy: {i.name}"
                 )
                 continue
+            self.journal.set(i.hash, "copied", RUNNING)
             if i.keep_dir_structure:
                 i.copy_subtree()
                 log.info(f"Copied subtrees for: {i.name}")
             if not i.keep_dir_structure:
                 i.copy_files_only()
                 log.info(f"Copied files for: {i.name}")
-            if i.check_copy_completed():
+            if i.check_copy_completed() and (
+                not self.config.get("verifyCopies", False)
+                or i.verify_copies(
+                    self.qbitclient, self.config.get("verifyWorkers", 4), self.api
+                )
+            ):
+                self.journal.set(i.hash, "copied", DONE)
                 self.qbitclient.torrents_add_tags(tags="Copied", torrent_hashes=i.hash)
-            i.delete_empty_dirs_recursively(i.destination_dir)
+            else:
+                self.journal.set(i.hash, "copied", FAILED)
+            if not i.from_file_list:
+                i.delete_empty_dirs_recursively(i.destination_dir)
             if i.scan_plex:
-                log.info(f"Running Plex scan subprocess for {i.name}")
-                i.plex_scan()
+                log.info(f"Requesting Plex scan for {i.name}")
+                self.scan_coordinator.request(i.destination_dir)
+        if not found:
+            log.info("No completed downloads to copy")
+        self.scan_coordinator.flush()
@@ -0,0 +1,57 @@
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from threading import BoundedSemaphore, Lock
+
+log = logging.getLogger(__name__)
+
+
+class DeviceLimiter:
+    """caps how many filesystem jobs run at once on each block device, identified by st_dev"""
+
+    def __init__(self, per_device):
+        self.per_device = max(1, per_device)
+        self._semaphores = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def device_of(path):
+        """gets the device id of a path or of its nearest existing parent
+        Args:
+            path: file system path
+        Returns:
+            st_dev of the path or None if nothing in its ancestry exists
+        """
+        path = Path(path)
+        for candidate in (path, *path.parents):
+            try:
+                return os.stat(candidate).st_dev
+            except FileNotFoundError:
+                continue
+        return None
+
+    def semaphore(self, device):
+        with self._lock:
+            if device not in self._semaphores:
+                self._semaphores[device] = BoundedSemaphore(self.per_device)
+            return self._semaphores[device]
+
+    @contextmanager
+    def hold(self, *paths):
+        """holds a slot on every device the paths live on
+        slots are taken in device order so jobs spanning two devices cannot deadlock each other
+        Args:
+            paths: paths the job reads or writes
+        """
+        devices = sorted({self.device_of(path) for path in paths} - {None})
+        acquired = []
+        try:
+            for device in devices:
+                semaphore = self.semaphore(device)
+                semaphore.acquire()
+                acquired.append(semaphore)
+            yield
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
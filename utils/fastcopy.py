@@ -0,0 +1,122 @@
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import time
+
+from utils.device_limits import DeviceLimiter
+
+log = logging.getLogger(__name__)
+
+FICLONE = 0x40049409  # linux ioctl that shares extents between files on btrfs/XFS
+CHUNK_SIZE = 64 * 1024 * 1024
+# errors meaning a method is unsupported for this pair of files rather than a failed copy
+UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EPERM,
+    errno.EBADF,
+}
+
+
+def same_device(source, destination_dir):
+    """checks if a hard link from source into destination_dir is possible by comparing st_dev
+    Args:
+        source: file or directory to link
+        destination_dir: directory to link into, or its nearest existing parent
+    Returns: bool
+    """
+    source_device = DeviceLimiter.device_of(source)
+    return source_device is not None and source_device == DeviceLimiter.device_of(
+        destination_dir
+    )
+
+
+def reflink(source, destination):
+    """clones the file's extents without copying data. raises OSError when the filesystem can't"""
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def copy_range(source, destination):
+    """copies in the kernel with copy_file_range, which can also offload to the storage"""
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        while os.copy_file_range(src.fileno(), dst.fileno(), CHUNK_SIZE):
+            pass
+
+
+def send_file(source, destination):
+    """copies in the kernel with sendfile"""
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        offset = 0
+        while True:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, CHUNK_SIZE)
+            if not sent:
+                break
+            offset += sent
+
+
+def buffered_copy(source, destination):
+    """copies through userspace with a large buffer"""
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+COPY_METHODS = (
+    ("reflink", reflink),
+    ("copy_file_range", copy_range),
+    ("sendfile", send_file),
+    ("buffered", buffered_copy),
+)
+
+
+def link_or_copy(source, destination, link=True):
+    """hard links a file or copies it with the fastest method the filesystems support
+    tries in order: hard link, reflink, copy_file_range, sendfile and a buffered copy.
+    the file is made under a temporary name next to destination and renamed over it, so an existing destination,
+    such as one left by a copy that was cut off, is replaced rather than failing the copy
+    Args:
+        source: path of file to copy
+        destination: path of new file
+        link: try a hard link first, pass False when source and destination are on different devices
+    Returns:
+        name of the method that made the file, 'existing' if destination already is a hard link to source
+    """
+    start = time.monotonic()
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        log.debug(f"Already linked: {destination}")
+        return "existing"
+    directory, name = os.path.split(destination)
+    temporary = os.path.join(directory, f".{name}.qbitmgr-tmp")
+    if os.path.lexists(temporary):
+        os.unlink(temporary)
+    methods = COPY_METHODS
+    if link:
+        methods = (("hardlink", os.link),) + methods
+    for method, function in methods:
+        try:
+            function(source, temporary)
+        except (OSError, AttributeError) as e:
+            if os.path.lexists(temporary):
+                os.unlink(temporary)
+            if isinstance(e, OSError) and e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            continue
+        try:
+            if method != "hardlink":
+                shutil.copystat(source, temporary)
+            os.replace(temporary, destination)
+        except OSError:
+            os.unlink(temporary)
+            raise
+        log.log(
+            logging.DEBUG if method == "hardlink" else logging.INFO,
+            f"{method}: {os.path.basename(source)} ({os.path.getsize(destination)} bytes) "
+            f"in {time.monotonic() - start:.1f}s",
+        )
+        return method
+    raise OSError(f"No copy method succeeded for {source}")
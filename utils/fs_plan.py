@@ -0,0 +1,251 @@
+import errno
+import logging
+import os
+from operator import itemgetter
+
+from utils.metrics import count_file
+
+log = logging.getLogger(__name__)
+
+UNLINK = "unlink"
+RENAME = "rename"
+RMDIR = "rmdir"
+DIRECTORY_FLAGS = os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)
+
+
+def disk_listing(directory):
+    """lists a directory with one os.scandir for FsPlan, sizes are only read for files the plan acts on"""
+    with os.scandir(directory) as entries:
+        return [
+            (
+                entry.name,
+                entry.is_dir(follow_symlinks=False),
+                lambda entry=entry: entry.stat(follow_symlinks=False).st_size,
+            )
+            for entry in sorted(entries, key=lambda entry: entry.name)
+        ]
+
+
+def mismatched_files(files):
+    """checks a file list against the disk with one stat per file, reading no directories
+    Args:
+        files: iterable of (path, size) tuples
+    Returns:
+        list of paths that are missing or have a different size on disk
+    """
+    mismatched = []
+    for path, size in files:
+        try:
+            if os.stat(path, follow_symlinks=False).st_size != size:
+                mismatched.append(path)
+        except FileNotFoundError:
+            mismatched.append(path)
+    return mismatched
+
+
+def torrent_file_list(qbitclient, torrent_hash, save_path, name, check=False):
+    """gets a torrent's files from qbittorrent's file list, so its content tree does not have to be read
+    Args:
+        qbitclient: qbittorrentapi client
+        torrent_hash: hash of the torrent
+        save_path: directory the file list's names are relative to
+        name: name of the torrent, for logging
+        check: stat every file and give up on the list if any is missing or a different size on disk
+    Returns:
+        list of (path, size) tuples, None if the check found the list out of date and the disk has to be read
+    """
+    files = [
+        (os.path.normpath(os.path.join(save_path, i["name"])), i["size"])
+        for i in qbitclient.torrents_files(torrent_hash=torrent_hash)
+    ]
+    if check:
+        mismatched = mismatched_files(files)
+        if mismatched:
+            log.warning(
+                f"File list of {name} does not match the disk for {len(mismatched)} files, "
+                f"such as {mismatched[0]}. Reading the disk instead"
+            )
+            return None
+    return files
+
+
+class FsPlan:
+    """
+    plans the cleanup of a download's content tree in a single os.scandir traversal, or from the torrent's file list
+    without reading the tree at all, then carries it out with syscalls relative to open directory fds so paths are
+    not resolved again for every file.
+    destination name collisions are caught while planning, and a plan can be described instead of run for a dry run
+    """
+
+    def __init__(self, root):
+        self.root = os.path.normpath(os.fspath(root))
+        # (operation, directory, name, size, destination directory) in the order to run them
+        self.operations = []
+        # files left in place because their name is taken in the destination
+        self.collisions = []
+
+    def scan(self, keep_extensions=(), flatten_to=None):
+        """plans deleting files without a kept extension and, when flatten_to is given, moving the remaining files
+        into flatten_to and removing the directories that leaves empty, the root included
+        Args:
+            keep_extensions: tuple of file extensions including period to keep, empty to keep all files
+            flatten_to: directory to move kept files into, None to leave them where they are
+        Returns:
+            self
+        """
+        return self._plan(disk_listing, keep_extensions, flatten_to)
+
+    def plan_files(self, files, keep_extensions=(), flatten_to=None):
+        """plans the same as scan() from a list of the files under root, such as a torrent's file list, instead of
+        reading the directories. the plan only knows of the listed files, a directory that turns out to hold other
+        files is kept when the plan runs
+        Args:
+            files: iterable of (path, size) tuples, paths outside root are left out
+            keep_extensions: tuple of file extensions including period to keep, empty to keep all files
+            flatten_to: directory to move kept files into, None to leave them where they are
+        Returns:
+            self
+        """
+        listing = {}
+        directories = {self.root}
+        for path, size in files:
+            path = os.path.normpath(os.fspath(path))
+            if not path.startswith(self.root + os.sep):
+                continue
+            directory, name = os.path.split(path)
+            listing.setdefault(directory, []).append(
+                (name, False, lambda size=size: size)
+            )
+            while directory not in directories:
+                directories.add(directory)
+                parent, name = os.path.split(directory)
+                listing.setdefault(parent, []).append((name, True, None))
+                directory = parent
+        return self._plan(
+            lambda directory: sorted(listing.get(directory, []), key=itemgetter(0)),
+            keep_extensions,
+            flatten_to,
+        )
+
+    def _plan(self, list_directory, keep_extensions, flatten_to):
+        taken = None
+        if flatten_to is not None:
+            flatten_to = os.path.normpath(os.fspath(flatten_to))
+            taken = set(os.listdir(flatten_to))
+        emptied = self._walk(
+            self.root, list_directory, tuple(keep_extensions), flatten_to, taken
+        )
+        if emptied and flatten_to is not None:
+            parent, name = os.path.split(self.root)
+            self.operations.append((RMDIR, parent, name, 0, None))
+        return self
+
+    def _walk(self, directory, list_directory, keep_extensions, flatten_to, taken):
+        """plans one directory, children first
+        Args:
+            list_directory: function returning a directory's (name, is directory, function returning size) tuples
+                sorted by name
+        Returns:
+            True if the directory is empty once the plan has run
+        """
+        empty = True
+        for name, is_dir, size in list_directory(directory):
+            if is_dir:
+                if (
+                    self._walk(
+                        os.path.join(directory, name),
+                        list_directory,
+                        keep_extensions,
+                        flatten_to,
+                        taken,
+                    )
+                    and flatten_to is not None
+                ):
+                    self.operations.append((RMDIR, directory, name, 0, None))
+                else:
+                    empty = False
+            elif keep_extensions and not name.endswith(keep_extensions):
+                self.operations.append((UNLINK, directory, name, size(), None))
+            elif flatten_to is None:
+                empty = False
+            elif name in taken:
+                log.info(
+                    f"Cannot move to {flatten_to}, because path already exists for: {name}"
+                )
+                self.collisions.append(os.path.join(directory, name))
+                empty = False
+            else:
+                taken.add(name)
+                self.operations.append((RENAME, directory, name, size(), flatten_to))
+        return empty
+
+    def describe(self):
+        """lists the plan as readable lines"""
+        lines = []
+        for operation, directory, name, size, destination in self.operations:
+            path = os.path.join(directory, name)
+            if operation == UNLINK:
+                lines.append(f"delete {path} ({size} bytes)")
+            elif operation == RENAME:
+                lines.append(f"move {path} -> {os.path.join(destination, name)}")
+            else:
+                lines.append(f"remove empty directory {path}")
+        lines.extend(
+            f"keep {path}: name taken in destination" for path in self.collisions
+        )
+        return lines
+
+    def execute(self, instance="default"):
+        """runs the plan. files already gone are skipped and directories still holding files are kept
+        Args:
+            instance: name of the qbittorrent instance the download belongs to, for metrics
+        Returns: None
+        """
+        fds = {}
+
+        def fd(directory):
+            if directory not in fds:
+                parent, name = os.path.split(directory)
+                if parent in fds:
+                    fds[directory] = os.open(name, DIRECTORY_FLAGS, dir_fd=fds[parent])
+                else:
+                    fds[directory] = os.open(directory, DIRECTORY_FLAGS)
+            return fds[directory]
+
+        try:
+            for operation, directory, name, size, destination in self.operations:
+                path = os.path.join(directory, name)
+                try:
+                    if operation == UNLINK:
+                        os.unlink(name, dir_fd=fd(directory))
+                        count_file("cleaner", "deleted", size, instance)
+                        log.debug(f"Deleted file: {name}")
+                    elif operation == RENAME:
+                        os.rename(
+                            name,
+                            name,
+                            src_dir_fd=fd(directory),
+                            dst_dir_fd=fd(destination),
+                        )
+                        count_file("cleaner", "moved", size, instance)
+                        log.debug(f"Moved file: {name}")
+                    else:
+                        if path in fds:
+                            os.close(fds.pop(path))
+                        os.rmdir(name, dir_fd=fd(directory))
+                        log.debug(f"Deleted empty directory: {path}")
+                # a plan made from a file list can be out of date, and a run cut off part way leaves done operations
+                except FileNotFoundError:
+                    log.debug(f"Already gone: {path}")
+                except OSError as e:
+                    if operation != RMDIR or e.errno not in (
+                        errno.ENOTEMPTY,
+                        errno.EEXIST,
+                    ):
+                        raise
+                    log.info(
+                        f"Kept directory holding files the plan did not list: {path}"
+                    )
+        finally:
+            for i in fds.values():
+                os.close(i)
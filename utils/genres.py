@@ -0,0 +1,51 @@
+import logging
+import os
+from functools import lru_cache
+
+log = logging.getLogger(__name__)
+
+
+class GenreResolver:
+    """
+    maps torrents to genres in config
+    genres are indexed once by name and category prefix (for category matches) and by normalized moveToDir path,
+    and lookups are memoized on (save_path, category)
+    """
+
+    def __init__(self, genres, cache_size=65536):
+        """
+        Args:
+            genres: dict of genre name -> Genre record, as in Config.genres
+            cache_size: lookups to memoize
+        """
+        self.by_category = {key: key for key in genres}
+        # categories made by AddCategory are named "<GENRE> - <name>"
+        self.by_prefix = {key.upper(): key for key in genres}
+        self.by_path = {}
+        for key, val in genres.items():
+            if val.move_to_dir:
+                self.by_path.setdefault(val.move_to_dir, key)
+        self.resolve = lru_cache(maxsize=cache_size)(self._resolve)
+
+    def _resolve(self, save_path, category=None):
+        """gets genre of torrent
+        first tries to match the torrent's category, or its "<GENRE> - " prefix, to a named genre
+        then tries to match the parent directory of the save path to a genre's moveToDir or, for downloads kept
+        under <downloads>/<genre>/<category>, to a genre's name
+
+        Args:
+            save_path: torrent save_path
+            category: torrent category, None to match on save path only
+        Returns:
+            genre from config or False
+        """
+        if category in self.by_category:
+            return self.by_category[category]
+        if category:
+            prefix, sep, _ = category.partition(" - ")
+            if sep and prefix in self.by_prefix:
+                return self.by_prefix[prefix]
+        genre_path = os.path.dirname(os.path.normpath(save_path))
+        if genre_path in self.by_path:
+            return self.by_path[genre_path]
+        return self.by_category.get(os.path.basename(genre_path), False)
@@ -0,0 +1,188 @@
+import csv
+import io
+import logging
+import sys
+from pathlib import Path
+
+import toml
+
+from utils.add_cat import AddCategory
+from utils.add_rule import RSSRule
+from utils.config import RSSTemplate
+
+log = logging.getLogger(__name__)
+
+# rule fields qbittorrent updates itself as a rule matches, not a difference worth resetting them for
+RULE_STATE_FIELDS = {"lastMatch", "previouslyMatchedEpisodes"}
+
+
+def rule_value(key, value):
+    """puts a rule field into the type qbittorrent keeps it as, so a config value and the value the API sends back
+    compare equal when qbittorrent would store them the same, e.g. episodeFilter = false is stored as ''
+    Args:
+        key: rule field
+        value: value from the config or from rss_rules()
+    Returns:
+        normalized value
+    """
+    default = RSSTemplate.DEFAULTS.get(key)
+    if isinstance(default, bool):
+        return bool(value)
+    if isinstance(default, int):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return int(value)
+        return 0
+    if isinstance(default, str):
+        return value if isinstance(value, str) else ""
+    if isinstance(default, list):
+        return [str(i) for i in value] if isinstance(value, (list, tuple)) else []
+    return value
+
+
+def read_entries(source, default_genre=""):
+    """reads (name, genre) pairs to import
+    a .toml file maps genres to lists of names, e.g. tv = ['Show One', 'Show Two'].
+    anything else, stdin included, is csv with a name and an optional genre per row
+    Args:
+        source: file path, '-' for stdin
+        default_genre: genre of csv rows that do not give one
+    Returns:
+        list of (name, genre) tuples in the order read, without duplicates
+    """
+    if source == "-":
+        text = sys.stdin.read()
+    else:
+        text = Path(source).read_text()
+    entries = []
+    if source != "-" and Path(source).suffix == ".toml":
+        for genre, names in toml.loads(text).items():
+            entries.extend((str(name).strip(), genre) for name in names)
+    else:
+        for row in csv.reader(io.StringIO(text)):
+            row = [i.strip() for i in row]
+            if not row or not row[0] or row[0].startswith("#"):
+                continue
+            if [i.lower() for i in row[:2]] == ["name", "genre"]:
+                continue
+            genre = row[1] if len(row) > 1 and row[1] else default_genre
+            entries.append((row[0], genre))
+    return list(dict.fromkeys(entries))
+
+
+class Importer:
+    """
+    adds categories and RSS rules for many names at once. existing rules and categories are fetched once, and only
+    missing categories, missing rules and rules whose definition changed are sent to qbittorrent
+    """
+
+    def __init__(self, config, qbitclient, api=None, dry_run=False):
+        self.config = config
+        self.qbitclient = qbitclient
+        if api is None:
+            # imported here so reading entries does not load the api client
+            from utils.async_client import SerialClient
+
+            api = SerialClient(qbitclient)
+        self.api = api
+        self.dry_run = dry_run
+
+    def plan(self, entries):
+        """compares entries with what qbittorrent already has
+        Args:
+            entries: list of (name, genre) tuples
+        Returns:
+            dict of lists: 'categories' AddCategory objs to create, 'new_rules' and 'changed_rules' RSSRule objs to set,
+            'existing_categories' and 'unchanged_rules' names, 'invalid' (name, genre, reason) tuples of entries skipped
+            because their genre is unknown or has no rssRules
+        """
+        existing_categories = self.qbitclient.torrents_categories()
+        existing_rules = self.qbitclient.rss_rules()
+        plan = {
+            "categories": [],
+            "existing_categories": [],
+            "new_rules": [],
+            "changed_rules": [],
+            "unchanged_rules": [],
+            "invalid": [],
+        }
+        for name, genre in entries:
+            if genre not in self.config.genres:
+                plan["invalid"].append((name, genre, f"unknown genre {genre!r}"))
+                continue
+            try:
+                rule = RSSRule(self.config, self.qbitclient, name, genre)
+            except ValueError as e:
+                plan["invalid"].append((name, genre, str(e)))
+                continue
+            category = AddCategory(self.config, self.qbitclient, name, genre)
+            if category.name in existing_categories:
+                plan["existing_categories"].append(category.name)
+            else:
+                plan["categories"].append(category)
+            existing = existing_rules.get(rule.rule_name)
+            if existing is None:
+                plan["new_rules"].append(rule)
+            elif any(
+                rule_value(key, existing.get(key)) != rule_value(key, val)
+                for key, val in rule.specification.items()
+                if key not in RULE_STATE_FIELDS
+            ):
+                plan["changed_rules"].append(rule)
+            else:
+                plan["unchanged_rules"].append(rule.rule_name)
+        return plan
+
+    def run(self, entries):
+        """creates the missing categories and sets new and changed rules, or only logs them in a dry run
+        Args:
+            entries: list of (name, genre) tuples
+        Returns:
+            plan dict from plan()
+        """
+        plan = self.plan(entries)
+        for name, genre, reason in plan["invalid"]:
+            log.warning(f"Skipping {name}: {reason}")
+        prefix = "Would create" if self.dry_run else "Creating"
+        for category in plan["categories"]:
+            log.info(f"{prefix} category: {category.name}")
+        for rule in plan["new_rules"]:
+            log.info(f"{prefix} rule: {rule.rule_name}")
+        for rule in plan["changed_rules"]:
+            log.info(
+                f"{'Would update' if self.dry_run else 'Updating'} rule: {rule.rule_name}"
+            )
+        if self.dry_run:
+            return plan
+        # categories first so rules never point at a category that does not exist yet
+        self.api.gather(
+            [
+                (
+                    "torrents_create_category",
+                    (),
+                    {"name": category.name, "save_path": str(category.save_path)},
+                )
+                for category in plan["categories"]
+            ]
+        )
+        self.api.gather(
+            [
+                (
+                    "rss_set_rule",
+                    (),
+                    {"rule_name": rule.rule_name, "rule_def": rule.specification},
+                )
+                for rule in plan["new_rules"] + plan["changed_rules"]
+            ]
+        )
+        return plan
+
+    @staticmethod
+    def summary(plan, dry_run=False):
+        """one line summary of a plan"""
+        created = "to create" if dry_run else "created"
+        updated = "to update" if dry_run else "updated"
+        return (
+            f"Categories: {len(plan['categories'])} {created}, {len(plan['existing_categories'])} already exist. "
+            f"Rules: {len(plan['new_rules'])} {created}, {len(plan['changed_rules'])} {updated}, "
+            f"{len(plan['unchanged_rules'])} unchanged. Skipped {len(plan['invalid'])} with an unknown genre or no rssRules"
+        )
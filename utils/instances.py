@@ -0,0 +1,89 @@
+import logging
+from pathlib import Path
+
+from utils.async_client import make_api
+from utils.config import Config, ConfigError
+from utils.genres import GenreResolver
+from utils.journal import Journal
+from utils.metrics import InstrumentedClient
+from utils.torrent_store import DEFAULT_PAGE_SIZE, DEFAULT_SORT, TorrentStore
+
+log = logging.getLogger(__name__)
+
+
+def instance_configs(config):
+    """splits config into one config per qbittorrent instance
+    every [[instances]] entry is the top level config with the entry's keys replacing top level ones, tables included.
+    without [[instances]] the top level config is the only instance, named 'default'.
+    instances that do not set their own journalFile get one named after them
+    Args:
+        config: config dict loaded from config.toml
+    Returns:
+        dict of instance name -> Config obj, with the name under 'name'
+    Raises:
+        ConfigError if an instance has no name or host, two instances have the same name or an instance's config is
+        not valid
+    """
+    entries = config.get("instances") or [{"name": "default"}]
+    base = {key: val for key, val in config.items() if key != "instances"}
+    configs = {}
+    for entry in entries:
+        name = entry.get("name") or entry.get("host")
+        if not name:
+            raise ConfigError(
+                "Invalid config: instances: an entry has no 'name' or 'host'"
+            )
+        if name in configs:
+            raise ConfigError(
+                f"Invalid config: instances: duplicate qbittorrent instance name '{name}'"
+            )
+        instance_config = {**base, **entry, "name": name}
+        if len(entries) > 1 and "journalFile" not in entry:
+            journal_file = Path(base.get("journalFile", "qbitmgr.db"))
+            instance_config["journalFile"] = str(
+                journal_file.with_name(
+                    f"{journal_file.stem}-{name}{journal_file.suffix}"
+                )
+            )
+        configs[name] = Config(instance_config)
+    return configs
+
+
+class Instance:
+    """the client, torrent store, genres and journal of one qbittorrent instance"""
+
+    def __init__(self, name, config, base_dir):
+        self.name = name
+        self.config = config
+        self.qbitclient = InstrumentedClient(
+            host=config["host"],
+            username=config["username"],
+            password=config["password"],
+            instance=name,
+        )
+        self.torrent_store = TorrentStore(
+            self.qbitclient,
+            config.get("listPageSize", DEFAULT_PAGE_SIZE),
+            config.get("listSortKey", DEFAULT_SORT),
+        )
+        self.genre_resolver = GenreResolver(config.genres)
+        self.journal = Journal(Path(base_dir, config.get("journalFile", "qbitmgr.db")))
+        self._api = None
+
+    @property
+    def api(self):
+        """SerialClient or, in asyncMode, a started AsyncClient for the instance"""
+        if self._api is None:
+            self._api = make_api(self.config, self.qbitclient)
+        return self._api
+
+    def reload(self, config):
+        """switches to a new config, keeping the client, torrent store and journal"""
+        self.config = config
+        self.torrent_store.page_size = config.get("listPageSize", DEFAULT_PAGE_SIZE)
+        self.torrent_store.sort = config.get("listSortKey", DEFAULT_SORT)
+        self.genre_resolver = GenreResolver(config.genres)
+
+    def close(self):
+        if self._api:
+            self._api.stop()
@@ -0,0 +1,88 @@
+import logging
+import sqlite3
+import time
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Journal:
+    """
+    sqlite journal of the pipeline stages ('processed', 'copied', 'scanned') each torrent has been through
+    keyed by info hash. qbittorrent tags are still added as a mirror for the UI
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._connection = sqlite3.connect(
+            str(path), check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS stages ("
+            "hash TEXT NOT NULL, stage TEXT NOT NULL, state TEXT NOT NULL, "
+            "updated_on REAL NOT NULL, detail TEXT NOT NULL DEFAULT '', "
+            "PRIMARY KEY (hash, stage))"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS stages_state ON stages (stage, state)"
+        )
+
+    def set(self, hash, stage, state, detail=""):
+        """records the state of a torrent's pipeline stage
+        Args:
+            hash: torrent hash
+            stage: pipeline stage
+            state: PENDING, RUNNING, DONE or FAILED
+            detail: optional text such as an error message
+        Returns: None
+        """
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)",
+                (hash, stage, state, time.time(), detail),
+            )
+
+    def state(self, hash, stage):
+        """gets the state of a torrent's pipeline stage or None if it was never recorded"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state FROM stages WHERE hash = ? AND stage = ?", (hash, stage)
+            ).fetchone()
+        return row[0] if row else None
+
+    def hashes(self, stage, *states):
+        """gets hashes of torrents whose stage is in one of the given states
+        Returns: set of hashes
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT hash FROM stages WHERE stage = ? AND state IN ({','.join('?' * len(states))})",
+                (stage, *states),
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def forget(self, keep_hashes):
+        """deletes journal rows of torrents that are no longer in the client
+        Args:
+            keep_hashes: hashes of torrents still in the client
+        Returns: None
+        """
+        with self._lock:
+            known = {
+                row[0]
+                for row in self._connection.execute("SELECT DISTINCT hash FROM stages")
+            }
+            gone = known - set(keep_hashes)
+            self._connection.executemany(
+                "DELETE FROM stages WHERE hash = ?", ((i,) for i in gone)
+            )
+        if gone:
+            log.debug(f"Forgot {len(gone)} torrents no longer in the client")
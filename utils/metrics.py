@@ -0,0 +1,209 @@
+import logging
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+import qbittorrentapi
+
+log = logging.getLogger(__name__)
+
+
+class Metric:
+    """a metric family with labels, rendered in the prometheus text format"""
+
+    kind = ""
+
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[i]) for i in self.labels)
+
+    @staticmethod
+    def escape(value):
+        """escapes a label value for the text exposition format: backslash, double quote and line feed"""
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    @staticmethod
+    def format_labels(names, values, extra=""):
+        pairs = [
+            f'{name}="{Metric.escape(str(value))}"'
+            for name, value in zip(names, values)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(
+                    f"{self.name}{self.format_labels(self.labels, key)} {value}"
+                )
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_, labels=(), buckets=(0.1, 1, 10, 60, 300)):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0, 0)
+            )
+            counts = [c + (value <= b) for c, b in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bucket, bucket_count in zip(self.buckets, counts):
+                    labels = self.format_labels(self.labels, key, f'le="{bucket}"')
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = self.format_labels(self.labels, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = self.format_labels(self.labels, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+REGISTRY = []
+
+TASK_DURATION = Histogram(
+    "qbitmgr_task_duration_seconds",
+    "Duration of scheduled task runs",
+    ["task"],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600),
+)
+TASK_INTERVAL = Gauge(
+    "qbitmgr_task_interval_seconds", "Configured interval of scheduled tasks", ["task"]
+)
+TASK_SKIPPED = Counter(
+    "qbitmgr_task_skipped_total",
+    "Scheduled runs skipped because the previous run was still going",
+    ["task"],
+)
+API_REQUESTS = Counter(
+    "qbitmgr_api_requests_total",
+    "qBittorrent Web API requests by instance, endpoint and outcome",
+    ["instance", "endpoint", "outcome"],
+)
+API_LATENCY = Histogram(
+    "qbitmgr_api_request_duration_seconds",
+    "qBittorrent Web API request latency by instance and endpoint",
+    ["instance", "endpoint"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 15),
+)
+TORRENTS_CLASSIFIED = Counter(
+    "qbitmgr_torrents_classified_total",
+    "Downloads assigned to a share limit group",
+    ["instance", "group"],
+)
+FILES = Counter(
+    "qbitmgr_files_total",
+    "Files deleted, moved, linked or copied",
+    ["instance", "component", "action"],
+)
+BYTES = Counter(
+    "qbitmgr_bytes_total",
+    "Bytes of files deleted, moved, linked or copied",
+    ["instance", "component", "action"],
+)
+
+
+def count_file(component, action, size, instance="default"):
+    """records one file handled by the cleaner or copier"""
+    FILES.inc(instance=instance, component=component, action=action)
+    BYTES.inc(size, instance=instance, component=component, action=action)
+
+
+def render():
+    """renders every metric in the prometheus text format"""
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+class InstrumentedClient(qbittorrentapi.Client):
+    """qbittorrentapi client that counts and times every request by endpoint, labelled with its instance name"""
+
+    def __init__(self, *args, instance="default", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.instance = instance
+
+    def _request(self, http_method, api_namespace, api_method, **kwargs):
+        # api_namespace is an APINames enum member, whose str() is "APINames.Torrents" on newer pythons
+        endpoint = f"{getattr(api_namespace, 'value', api_namespace)}/{api_method}"
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            response = super()._request(
+                http_method, api_namespace, api_method, **kwargs
+            )
+            outcome = "ok"
+            return response
+        finally:
+            API_LATENCY.observe(
+                time.monotonic() - start, instance=self.instance, endpoint=endpoint
+            )
+            API_REQUESTS.inc(instance=self.instance, endpoint=endpoint, outcome=outcome)
+
+
+class MetricsServer:
+    """serves /metrics over http from a background thread"""
+
+    def __init__(self, host, port):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    return self.send_error(404)
+                body = render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+
+    def start(self):
+        Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        log.info(
+            f"Serving metrics on http://{self._server.server_address[0]}:{self._server.server_address[1]}/metrics"
+        )
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
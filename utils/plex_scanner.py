@@ -1,69 +1,212 @@
 import logging
+import os
 import subprocess
-from pathlib import Path
+from threading import Lock, Timer
+
+from utils.journal import DONE, FAILED, PENDING
 
 log = logging.getLogger(__name__)
 
 
+class ScanCoordinator:
+    """
+    batches plex scans: directories requested within plexScanDebounce seconds of the first request are scanned
+    together, each directory once, as a partial scan of the library section it belongs to.
+    directories outside every configured section fall back to one full scan
+    """
+
+    def __init__(self, config):
+        self.pending = {}  # directory or None for a full scan -> list of callbacks
+        self.in_flight = set()
+        self.queued = set()  # keys of requests waiting on a scan (torrent hashes)
+        self._lock = Lock()
+        self._timer = None
+        self.configure(config)
+
+    def configure(self, config):
+        """takes the scan command, debounce and library sections from a config, for a start or a live reload.
+        scans already pending run with the new settings, a debounce already counting down is not restarted
+        """
+        # (library root, section id, library root as plex sees it) longest root first
+        sections = sorted(
+            (
+                (
+                    os.path.normpath(i["path"]),
+                    str(i["section"]),
+                    i.get("plexPath", i["path"]),
+                )
+                for i in config.get("plexLibrarySections", [])
+            ),
+            key=lambda section: len(section[0]),
+            reverse=True,
+        )
+        with self._lock:
+            self.command = list(config["plexScanCommand"])
+            self.debounce = config.get("plexScanDebounce", 30)
+            self.sections = sections
+
+    def scan_command(self, directory):
+        """builds the scan command for a directory
+        Args:
+            directory: directory with new files, None for a full scan
+        Returns:
+            command list
+        """
+        if directory is None:
+            return self.command
+        for root, section, plex_root in self.sections:
+            if directory == root or directory.startswith(root + os.sep):
+                plex_directory = plex_root + directory[len(root) :]
+                return self.command + [
+                    "--section",
+                    section,
+                    "--directory",
+                    plex_directory,
+                ]
+        return self.command
+
+    def is_queued(self, key):
+        """whether a request made with this key is still waiting on its scan"""
+        with self._lock:
+            return key in self.queued
+
+    def request(self, directory, callback=None, key=None):
+        """asks for a directory to be scanned
+        Args:
+            directory: directory with new files
+            callback: called with True or False when the scan finished or failed
+            key: identifies the request, queued until its scan finishes or fails
+        Returns:
+            False if the directory is already being scanned or the key is queued, True otherwise
+        """
+        directory = os.path.normpath(directory)
+        if not any(
+            directory == i[0] or directory.startswith(i[0] + os.sep)
+            for i in self.sections
+        ):
+            directory = None
+        with self._lock:
+            if key is not None and key in self.queued:
+                return False
+            if directory in self.in_flight:
+                log.debug(
+                    f"Plex scan already running for: {directory or 'all libraries'}"
+                )
+                return False
+            self.pending.setdefault(directory, [])
+            if key is not None:
+                self.queued.add(key)
+                self.pending[directory].append(self.dequeue(key, callback))
+            elif callback:
+                self.pending[directory].append(callback)
+            if self._timer is None:
+                self._timer = Timer(self.debounce, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return True
+
+    def dequeue(self, key, callback):
+        """makes a callback that takes a key off the queue before passing the outcome on"""
+
+        def finished(ok):
+            with self._lock:
+                self.queued.discard(key)
+            if callback:
+                callback(ok)
+
+        return finished
+
+    def flush(self):
+        """scans every pending directory now"""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            pending, self.pending = self.pending, {}
+            if None in pending:  # a full scan covers every directory
+                callbacks = [c for i in pending.values() for c in i]
+                pending = {None: callbacks}
+            self.in_flight.update(pending)
+        for directory, callbacks in pending.items():
+            ok = self.plex_scan(directory)
+            with self._lock:
+                self.in_flight.discard(directory)
+            for callback in callbacks:
+                callback(ok)
+
+    def plex_scan(self, directory):
+        """runs plex scan command as subprocess
+        Returns:
+            True if the command succeeded
+        """
+        command = self.scan_command(directory)
+        log.info(f"Running Plex scan for: {directory or 'all libraries'}")
+        try:
+            s_out = subprocess.check_output(command).strip().decode("UTF-8")
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.error(f"Plex scan command failed: {e}")
+            return False
+        log.debug(f"Plex scan finished, stdout: '{s_out}'")
+        return True
+
+
 class PlexScanner:
     """
     determines if plex should scan its libraries after a new download is completed
     and issues plex scan command
     """
 
-    def __init__(self, config, qbitclient):
+    def __init__(
+        self,
+        config,
+        qbitclient,
+        torrent_store,
+        genre_resolver,
+        journal,
+        scan_coordinator,
+    ):
         self.config = config
         self.qbitclient = qbitclient
+        self.torrent_store = torrent_store
+        self.genre_resolver = genre_resolver
+        self.journal = journal
+        self.scan_coordinator = scan_coordinator
+        self.seen_generation = 0
 
-    def get_completed_downloads(self):
-        """get the completed downloads unyet processed"""
-        completed_list = self.qbitclient.torrents_info(status_filter="completed")
-        return [
-            i
-            for i in completed_list
-            if "Processed" not in i.tags and self.get_genre(i.save_path)
-        ]
-
-    def get_genre(self, save_path):
-        """gets genre of torrent
-        Args:
-            save_path: torrent save_path
-        Returns:
-            genre from config or False
-        """
-        genre_path = Path(save_path).parent
-        for key, val in self.config["genres"].items():
-            if Path(val["moveToDir"]) == genre_path:
-                return key
-        return False
-
-    def plex_scan(self):
-        """runs plex scan command as subprocess"""
-        s_out = (
-            subprocess.check_output(self.config["plexScanCommand"])
-            .strip()
-            .decode("UTF-8")
-        )
-        if "Got nothing for: It's All Connected" in s_out:
-            log.debug(f"Plex scan success, stdout: '{s_out}'")
-        else:
-            log.debug(f"Plex scan failed, stdout: '{s_out}'")
+    def scan_finished(self, hash_):
+        """makes a callback that records the outcome of a torrent's scan"""
+
+        def callback(ok):
+            self.journal.set(hash_, "scanned", DONE if ok else FAILED)
+            if ok:
+                self.qbitclient.torrents_add_tags(tags="Scanned", torrent_hashes=hash_)
+
+        return callback
 
     def scan_if_needed(self):
-        """determines if scanning plex is required and runs command if needed"""
-        completed_downloads = self.qbitclient.torrents_info(status_filter="completed")
-        requires_scan = [
-            i.hash
-            for i in completed_downloads
-            if self.get_genre(i.save_path)
-            and self.config["genres"][self.get_genre(i.save_path)]["scanPlex"]
-            and "Scanned" not in i.tags
-        ]
-        if requires_scan:
-            log.debug("Running plex scan")
-            self.plex_scan()
-            self.qbitclient.torrents_add_tags(
-                tags="Scanned", torrent_hashes=requires_scan
+        """determines if scanning plex is required and runs command if needed
+        only torrents that changed since the last call or are still unfinished in the journal are considered
+        """
+        changed, self.seen_generation = self.torrent_store.changed_since(
+            self.seen_generation
+        )
+        requested = 0
+        for i in self.torrent_store.iter_torrents(
+            status_filter="completed",
+            torrent_hashes=changed | self.journal.hashes("scanned", PENDING, FAILED),
+        ):
+            if self.scan_coordinator.is_queued(i.hash):
+                continue
+            if "Scanned" in i.tags or self.journal.state(i.hash, "scanned") == DONE:
+                continue
+            genre = self.genre_resolver.resolve(i.save_path)
+            if not genre or not self.config.genres[genre].scan_plex:
+                continue
+            requested += 1
+            self.journal.set(i.hash, "scanned", PENDING)
+            # if the directory is being scanned already, it is retried once that scan is done
+            self.scan_coordinator.request(
+                i.save_path, self.scan_finished(i.hash), key=i.hash
             )
-        else:
+        if not requested:
             log.debug("No plex scan needed")
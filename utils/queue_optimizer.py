@@ -0,0 +1,160 @@
+import logging
+import math
+import time
+
+log = logging.getLogger(__name__)
+
+
+class QueueOptimizer:
+    """
+    orders qbittorrent's queue by how much each torrent is expected to upload.
+    scores are computed column by column over the whole torrent table, then the queue is moved into that order
+    with as few topPrio/bottomPrio calls as possible. a torrent keeps the score it was last ordered by until its
+    score moves by more than queueOptimizerHysteresis, so small swings in swarm counts do not reshuffle the queue
+    """
+
+    def __init__(self, config, qbitclient, torrent_store, matcher):
+        self.qbitclient = qbitclient
+        self.torrent_store = torrent_store
+        self.matcher = matcher
+        self.half_life = config.get("queueOptimizerAgeHalfLife", 7) * 86400
+        self.hysteresis = config.get("queueOptimizerHysteresis", 0.2)
+        self.held_scores = {}  # hash -> score the queue was last ordered by
+        self.weights = {group: val.weight for group, val in config.share_groups.items()}
+
+    def weight(self, tags):
+        return self.weights.get(self.matcher.match_tags(tags) or "default", 1)
+
+    @staticmethod
+    def remaining_budget(ratio, ratio_limit, seeding_time, seeding_time_limit):
+        """fraction of the ratio or seeding time limit left, whichever runs out first. 1 when unlimited"""
+        left = 1.0
+        if ratio_limit > 0:
+            left = min(left, 1 - ratio / ratio_limit)
+        if seeding_time_limit > 0:
+            left = min(left, 1 - seeding_time / (seeding_time_limit * 60))
+        return max(left, 0.0)
+
+    def scores(self, torrents):
+        """scores torrents by expected upload value
+        swarm leecher/seeder ratio x group weight x remaining share budget x age decay
+        Args:
+            torrents: list of TorrentRecord objs
+        Returns:
+            list of scores in the same order
+        """
+        now = time.time()
+        swarm = [
+            i.get("num_incomplete", 0) / (i.get("num_complete", 0) + 1)
+            for i in torrents
+        ]
+        weights = [self.weight(i.tags) for i in torrents]
+        budgets = [
+            self.remaining_budget(
+                i.get("ratio", 0),
+                i.get("ratio_limit", -1),
+                i.get("seeding_time", 0),
+                i.get("seeding_time_limit", -1),
+            )
+            for i in torrents
+        ]
+        ages = [
+            math.pow(0.5, max(now - i.get("added_on", now), 0) / self.half_life)
+            for i in torrents
+        ]
+        return [
+            w * (1 + s) * b * (0.5 + 0.5 * a)
+            for s, w, b, a in zip(swarm, weights, budgets, ages)
+        ]
+
+    @staticmethod
+    def plan_moves(target, positions):
+        """finds the fewest moves to the top or bottom of the queue that reach the target order.
+        the longest run of the target order already in increasing queue position stays put,
+        torrents before it go to the top and torrents after it go to the bottom
+        Args:
+            target: hashes in the wanted queue order
+            positions: dict of hash -> current queue position
+        Returns:
+            tuple of (hashes to move to top, in the order to call topPrio, hashes to move to bottom, in order)
+        """
+        if not target:
+            return [], []
+        best_start, best_length, start = 0, 1, 0
+        for i in range(1, len(target)):
+            if positions[target[i]] < positions[target[i - 1]]:
+                start = i
+            if i - start + 1 > best_length:
+                best_start, best_length = start, i - start + 1
+        to_top = list(reversed(target[:best_start]))
+        to_bottom = target[best_start + best_length :]
+        return to_top, to_bottom
+
+    def held(self, torrents, scores):
+        """replaces scores that moved by no more than the hysteresis fraction with the score last ordered by
+        Args:
+            torrents: list of TorrentRecord objs
+            scores: list of their scores from scores()
+        Returns:
+            list of scores to order by, in the same order
+        """
+        held = []
+        for torrent, score in zip(torrents, scores):
+            previous = self.held_scores.get(torrent.hash)
+            if previous is not None and abs(score - previous) <= self.hysteresis * abs(
+                previous
+            ):
+                score = previous
+            held.append(score)
+        self.held_scores = {i.hash: score for i, score in zip(torrents, held)}
+        return held
+
+    @staticmethod
+    def batches(hashes, positions):
+        """splits hashes, in the order they should end up in, into runs already in increasing queue position.
+        qbittorrent keeps the queue order of torrents moved in one topPrio or bottomPrio call, so a run is one call
+        Args:
+            hashes: hashes in the wanted order
+            positions: dict of hash -> current queue position
+        Returns:
+            list of lists of hashes
+        """
+        runs = []
+        for hash_ in hashes:
+            if runs and positions[hash_] > positions[runs[-1][-1]]:
+                runs[-1].append(hash_)
+            else:
+                runs.append([hash_])
+        return runs
+
+    def optimize(self):
+        """moves queued torrents into score order
+        Args: None
+        Returns: None
+        """
+        queued = [
+            i for i in self.torrent_store.torrents_info() if i.get("priority", 0) > 0
+        ]
+        if len(queued) < 2:
+            return
+        scores = self.held(queued, self.scores(queued))
+        target = [
+            i.hash
+            for _, i in sorted(
+                zip(scores, queued), key=lambda pair: (-pair[0], pair[1].priority)
+            )
+        ]
+        positions = {i.hash: i.priority for i in queued}
+        to_top, to_bottom = self.plan_moves(target, positions)
+        # the last run moved to the top ends up first
+        top_runs = self.batches(list(reversed(to_top)), positions)
+        for run in reversed(top_runs):
+            self.qbitclient.torrents_top_priority(torrent_hashes=run)
+        bottom_runs = self.batches(to_bottom, positions)
+        for run in bottom_runs:
+            self.qbitclient.torrents_bottom_priority(torrent_hashes=run)
+        if to_top or to_bottom:
+            log.info(
+                f"Reordered queue of {len(queued)} torrents, moving {len(to_top) + len(to_bottom)} in "
+                f"{len(top_runs) + len(bottom_runs)} calls"
+            )
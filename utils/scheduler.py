@@ -1,36 +1,152 @@
-from threading import Timer, Lock
+import logging
+import random
+import signal
+import time
+from collections import deque
+from threading import Condition, Event, Lock, Thread
 
+from utils.metrics import TASK_DURATION, TASK_INTERVAL, TASK_SKIPPED
 
-class Periodic:  # https://stackoverflow.com/a/18906292/16625038
-    """
-    A periodic task running in threading.Timers
-    """
+log = logging.getLogger(__name__)
 
-    def __init__(self, interval, function, *args, **kwargs):
-        self._lock = Lock()
-        self._timer = None
-        self.function = function
+
+class ScheduledTask:
+    """a function run every interval seconds, never overlapping with its own previous run"""
+
+    def __init__(self, name, interval, function, *args, jitter=0, **kwargs):
+        self.name = name
         self.interval = interval
+        self.jitter = jitter
+        self.function = function
         self.args = args
         self.kwargs = kwargs
+        self.next_run = time.monotonic() + random.uniform(0, jitter)
+        self.running = False
+        self.started = 0
+        self.rerun = False  # run_now was called while running, run again when done
+        self.skipped = 0
+        self.completed = 0
+        self.error = None  # exception of the last run, None if it succeeded
+        self.durations = deque(maxlen=100)
+        self.thread = None
+
+    def reschedule(self, now):
+        self.next_run = now + self.interval + random.uniform(0, self.jitter)
+
+
+class Scheduler:
+    """
+    runs tasks on their own intervals in worker threads
+    a task that is still running when it comes due again is skipped, and a task asked to run now while running is
+    run once more right after it finishes. SIGTERM and SIGINT stop the scheduler after running tasks finish
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self._lock = Lock()
+        self._done = Condition(self._lock)
+        self._wake = Event()
+        self._stopped = False
+
+    def add(self, name, interval, function, *args, jitter=0, **kwargs):
+        """adds a task
+        Args:
+            name: task name used in logs and by run_now
+            interval: seconds between runs
+            function: function to run with args and kwargs
+            jitter: up to this many random seconds are added to each interval
+        Returns:
+            ScheduledTask obj
+        """
+        task = ScheduledTask(name, interval, function, *args, jitter=jitter, **kwargs)
+        self.tasks[name] = task
+        TASK_INTERVAL.set(interval, task=name)
+        return task
+
+    def set_interval(self, name, interval):
+        """changes the seconds between runs of a task, from its next run on"""
+        with self._lock:
+            self.tasks[name].interval = interval
+        TASK_INTERVAL.set(interval, task=name)
+
+    def run_now(self, name, wait=False, timeout=None):
+        """runs a task as soon as possible, coalescing with a run in progress
+        Args:
+            name: task name
+            wait: True to wait for a run that started after this call to finish
+            timeout: seconds to wait at most, None for no limit
+        Returns:
+            True if waited for and finished, False otherwise
+        """
+        with self._lock:
+            task = self.tasks[name]
+            # a run in progress may have started before this call, so wait for the one after it
+            target = task.completed + (2 if task.running else 1)
+            if task.running:
+                task.rerun = True
+            else:
+                task.next_run = 0
+        self._wake.set()
+        if not wait:
+            return False
+        with self._done:
+            return self._done.wait_for(lambda: task.completed >= target, timeout)
+
+    def _launch(self, task, now):
+        if task.running:
+            task.skipped += 1
+            TASK_SKIPPED.inc(task=task.name)
+            log.warning(
+                f"Skipping {task.name}: previous run still going after {now - task.started:.1f}s"
+            )
+            return task.reschedule(now)
+        task.running = True
+        task.started = now
+        task.reschedule(now)
+        task.thread = Thread(target=self._run, args=(task,), name=task.name)
+        task.thread.start()
+
+    def _run(self, task):
+        start = time.monotonic()
+        error = None
+        try:
+            task.function(*task.args, **task.kwargs)
+        except Exception as e:
+            error = e
+            log.exception(f"Task {task.name} failed: {e}")
+        finally:
+            duration = time.monotonic() - start
+            with self._lock:
+                task.durations.append(duration)
+                task.running = False
+                task.error = error
+                task.completed += 1
+                self._done.notify_all()
+                if task.rerun:
+                    task.rerun = False
+                    task.next_run = 0
+            TASK_DURATION.observe(duration, task=task.name)
+            log.debug(f"Task {task.name} took {duration:.1f}s")
+            self._wake.set()
+
+    def stop(self, *_):
         self._stopped = True
-        if kwargs.pop("autostart", True):
-            self.start()
-
-    def start(self, from_run=False):
-        self._lock.acquire()
-        if from_run or self._stopped:
-            self._stopped = False
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-            self._lock.release()
-
-    def _run(self):
-        self.start(from_run=True)
-        self.function(*self.args, **self.kwargs)
-
-    def stop(self):
-        self._lock.acquire()
-        self._stopped = True
-        self._timer.cancel()
-        self._lock.release()
+        self._wake.set()
+
+    def run_forever(self):
+        """runs due tasks until stopped by stop(), SIGTERM or SIGINT, then waits for running tasks to finish"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self._stopped:
+            now = time.monotonic()
+            with self._lock:
+                for task in self.tasks.values():
+                    if task.next_run <= now:
+                        self._launch(task, now)
+                wait = min(task.next_run for task in self.tasks.values()) - now
+            self._wake.wait(max(0, wait))
+            self._wake.clear()
+        log.info("Stopping: waiting for running tasks to finish")
+        for task in self.tasks.values():
+            if task.thread:
+                task.thread.join()
@@ -1,119 +1,331 @@
 import logging
+import math
+
+from utils.async_client import SerialClient
+from utils.metrics import TORRENTS_CLASSIFIED
+from utils.queue_optimizer import QueueOptimizer
+from utils.share_matcher import ShareMatcher
+from utils.torrent_store import DOWNLOADING_STATES, SEEDING_STATES
 
 log = logging.getLogger(__name__)
 
 
 class LimitGroup:
-    """group of torrents that share limits specified in config. Sets share limits and order in qbittorrent queue."""
+    """group of torrents that share limits specified in config. Works out which limits each torrent is missing."""
 
-    def __init__(self, config, qbitclient, group, names, hashes):
+    def __init__(self, config, group, torrents, manage_upload_limit=True):
         self.group = group
+        self.manage_upload_limit = manage_upload_limit
+        self.torrents = torrents
+        self.names = [i.name for i in torrents]
+        self.hashes = [i.hash for i in torrents]
+        share_group = config.share_groups[group]
+        self.ratio_limit = share_group.ratio_limit
+        self.seeding_time_limit = share_group.seeding_time_limit
+        self.upload_speed_limit = share_group.upload_speed_limit
+        self.tags = share_group.tags
+        self.tag_names = share_group.tag_names
+        self.priority_in_queue = share_group.priority_in_queue
+
+    @staticmethod
+    def same_upload_limit(current, desired):
+        """compares upload limits, treating 0 and negative values as unlimited"""
+        return max(current, 0) == max(desired, 0)
+
+    def changes(self):
+        """compares the group's limits to each torrent's current values
+        Args: None
+        Returns:
+            list of (qbitclient method name, args, torrent hash) for every change a torrent needs
+        """
+        desired_tags = set(self.tag_names)
+        changes = []
+        for torrent in self.torrents:
+            if (
+                abs(torrent.get("ratio_limit", 0) - self.ratio_limit) > 1e-6
+                or torrent.get("seeding_time_limit") != self.seeding_time_limit
+            ):
+                changes.append(
+                    (
+                        "torrents_set_share_limits",
+                        (self.ratio_limit, self.seeding_time_limit),
+                        torrent.hash,
+                    )
+                )
+            if self.manage_upload_limit and not self.same_upload_limit(
+                torrent.get("up_limit", 0), self.upload_speed_limit
+            ):
+                changes.append(
+                    (
+                        "torrents_set_upload_limit",
+                        (self.upload_speed_limit,),
+                        torrent.hash,
+                    )
+                )
+            missing_tags = desired_tags - torrent.tags
+            if missing_tags:
+                changes.append(
+                    (
+                        "torrents_add_tags",
+                        (",".join(sorted(missing_tags)),),
+                        torrent.hash,
+                    )
+                )
+        return changes
+
+
+def share_out(budget, demands, weights):
+    """splits a budget weighted max-min fairly: nobody gets more than they demand and what they leave is shared
+    by the rest in proportion to their weights. budget left once every demand is met is spread by weight as headroom
+    Args:
+        budget: amount to split
+        demands: dict of key -> demand, may be math.inf
+        weights: dict of key -> weight
+    Returns:
+        dict of key -> allocation
+    """
+    allocation = {key: 0.0 for key in demands}
+    unsatisfied = {key for key, demand in demands.items() if demand > 0}
+    remaining = budget
+    while unsatisfied and remaining > 0:
+        total_weight = sum(weights[key] for key in unsatisfied)
+        satisfied = {
+            key
+            for key in unsatisfied
+            if allocation[key] + remaining * weights[key] / total_weight >= demands[key]
+        }
+        if not satisfied:
+            for key in unsatisfied:
+                allocation[key] += remaining * weights[key] / total_weight
+            return allocation
+        for key in satisfied:
+            remaining -= demands[key] - allocation[key]
+            allocation[key] = demands[key]
+        unsatisfied -= satisfied
+    total_weight = sum(weights[key] for key in demands if demands[key] > 0)
+    if remaining > 0 and total_weight:
+        for key in demands:
+            if demands[key] > 0:
+                allocation[key] += remaining * weights[key] / total_weight
+    return allocation
+
+
+class BandwidthAllocator:
+    """
+    redistributes a global upload budget across shareLimits groups every run.
+    groups share the budget by weight, torrents without leechers get nothing and the bandwidth they leave is shared
+    by the rest. per-torrent upload limits only change when they move by more than the hysteresis fraction
+    """
+
+    def __init__(self, config, qbitclient, torrent_store, matcher, api=None):
+        self.config = config
         self.qbitclient = qbitclient
-        self.names = names
-        self.hashes = hashes
-        self.ratio_limit = config["shareLimits"][self.group]["ratio_limit"]
-        self.seeding_time_limit = config["shareLimits"][self.group][
-            "seeding_time_limit"
-        ]
-        self.upload_speed_limit = config["shareLimits"][self.group][
-            "upload_speed_limit"
-        ]
-        self.tags = config["shareLimits"][group]["tags"]
-        self.priority_in_queue = config["shareLimits"][group]["priorityInQueue"]
-
-    def set_group_limits(self):
-        """sets share limits for group with qbitclient"""
-        self.qbitclient.torrents_set_share_limits(
-            self.ratio_limit,
-            self.seeding_time_limit,
-            torrent_hashes=self.hashes,
+        self.torrent_store = torrent_store
+        self.matcher = matcher
+        self.api = api or SerialClient(qbitclient)
+        settings = config["uploadAllocator"]
+        self.budget = settings["globalUploadLimit"]
+        self.hysteresis = settings.get("hysteresis", 0.2)
+        self.min_limit = settings.get("minTorrentLimit", 10240)
+        self.weights = {group: val.weight for group, val in config.share_groups.items()}
+
+    def torrent_group(self, torrent):
+        return self.matcher.match_tags(torrent.tags) or "default"
+
+    def demand(self, torrent):
+        """estimates how much a torrent could upload
+        a torrent running at its limit could use more, so its demand is unbounded
+        """
+        if not torrent.get("num_leechs"):
+            return 0
+        up_limit = torrent.get("up_limit", 0)
+        upspeed = torrent.get("upspeed", 0)
+        if up_limit > 0 and upspeed >= 0.9 * up_limit:
+            return math.inf
+        return upspeed * 1.5 + self.min_limit
+
+    def allocate(self):
+        """sets per-torrent upload limits so the budget goes where there are peers to upload to
+        Args: None
+        Returns: None
+        """
+        transfer = self.qbitclient.transfer_info()
+        budget = self.budget
+        if transfer.get("up_rate_limit", 0) > 0:
+            budget = min(budget, transfer["up_rate_limit"])
+        groups = {}
+        for torrent in self.torrent_store.iter_torrents():
+            if torrent.state in SEEDING_STATES | DOWNLOADING_STATES:
+                groups.setdefault(self.torrent_group(torrent), []).append(torrent)
+        torrent_demands = {
+            group: {i.hash: self.demand(i) for i in torrents}
+            for group, torrents in groups.items()
+        }
+        group_budgets = share_out(
+            budget,
+            {
+                group: sum(demands.values())
+                for group, demands in torrent_demands.items()
+            },
+            {group: self.weights.get(group, 1) for group in groups},
+        )
+        new_limits = {}
+        for group, torrents in groups.items():
+            demands = torrent_demands[group]
+            allocation = share_out(
+                group_budgets[group], demands, {hash_: 1 for hash_ in demands}
+            )
+            for torrent in torrents:
+                if not demands[torrent.hash]:
+                    continue
+                limit = max(
+                    self.min_limit, int(allocation[torrent.hash]) // 1024 * 1024
+                )
+                current = torrent.get("up_limit", 0)
+                if current > 0 and abs(limit - current) <= self.hysteresis * current:
+                    continue
+                new_limits.setdefault(limit, []).append(torrent.hash)
+        self.api.gather(
+            [
+                ("torrents_set_upload_limit", (limit,), {"torrent_hashes": hashes})
+                for limit, hashes in new_limits.items()
+            ]
         )
-        self.qbitclient.torrents_set_upload_limit(
-            self.upload_speed_limit, torrent_hashes=self.hashes
+        log.debug(
+            f"Uploading {transfer.get('up_info_speed', 0)} of {budget} B/s budget, "
+            f"changed upload limit of {sum(len(i) for i in new_limits.values())} torrents"
         )
-        self.qbitclient.torrents_add_tags(self.tags, torrent_hashes=self.hashes)
-        log.info(f"Limit set to {self.group} for {self.names}")
-        if self.priority_in_queue:
-            self.qbitclient.torrents_top_priority(torrent_hashes=self.hashes)
-            log.info(f"Moved priority torrents to top of queue: {self.names}")
 
 
 class ShareLimiter:
     """matches downloading torrents to limit groups in config and creates LimitGroup objects"""
 
-    def __init__(self, config, qbitclient):
+    def __init__(self, config, qbitclient, torrent_store, api=None):
         self.config = config
         self.qbitclient = qbitclient
+        self.torrent_store = torrent_store
+        self.api = api or SerialClient(qbitclient)
+        # hash -> (tracker signature, tracker urls), kept between runs
+        self.tracker_cache = {}
+        self.matcher = ShareMatcher(config.share_groups)
+        self.calls_saved = 0  # API calls skipped by set_limits since start
+        self.allocator = None
+        if config.get("uploadAllocator", {}).get("enabled"):
+            self.allocator = BandwidthAllocator(
+                config, qbitclient, torrent_store, self.matcher, self.api
+            )
+        self.queue_optimizer = None
+        if config.get("queueOptimizer", False):
+            self.queue_optimizer = QueueOptimizer(
+                config, qbitclient, torrent_store, self.matcher
+            )
 
     @staticmethod
-    def check_if_string_contains_any_match_term(match_terms, string_):
-        """returns true if any of list of match_terms are present in a string
+    def tracker_signature(torrent):
+        """summarizes the tracker fields of a torrent listing so changes to its tracker list can be detected
+        the working tracker is only part of the signature for torrents with a single tracker
         Args:
-            match_terms: list of terms that a string could contain
-            string_: string within which to find match_terms
+            torrent: TorrentRecord obj
+        Returns: tuple
+        """
+        trackers_count = torrent.get("trackers_count")
+        if trackers_count is not None and trackers_count <= 1:
+            return trackers_count, torrent.get("tracker", "")
+        return trackers_count, None
 
-        Returns: bool
+    def get_tracker_urls(self, torrent):
+        """gets tracker urls for a torrent from the cache, the torrent listing or the api in that order
+        torrents with a single working tracker are served from the listing's 'tracker' field without a request
+        Args:
+            torrent: TorrentRecord obj
+        Returns:
+            list of tracker urls
         """
-        return any(term.lower() in string_.lower() for term in match_terms)
+        signature = self.tracker_signature(torrent)
+        cached = self.tracker_cache.get(torrent.hash)
+        if cached and cached[0] == signature:
+            return cached[1]
+        if signature[1]:
+            urls = [signature[1]]
+        else:
+            urls = [
+                i.url
+                for i in self.qbitclient.torrents_trackers(torrent_hash=torrent.hash)
+            ]
+            log.debug(f"Fetched trackers for {torrent.name}")
+        self.tracker_cache[torrent.hash] = (signature, urls)
+        return urls
+
+    def prefetch_trackers(self, torrents):
+        """fetches trackers of the torrents that neither the cache nor the listing can answer for
+        the requests are independent, so they run concurrently in asyncMode
+        Args:
+            torrents: list of TorrentRecord objs
+        Returns: None
+        """
+        missing = []
+        for torrent in torrents:
+            signature = self.tracker_signature(torrent)
+            cached = self.tracker_cache.get(torrent.hash)
+            if not signature[1] and not (cached and cached[0] == signature):
+                missing.append((torrent, signature))
+        results = self.api.gather(
+            [
+                ("torrents_trackers", (), {"torrent_hash": torrent.hash})
+                for torrent, _ in missing
+            ]
+        )
+        for (torrent, signature), trackers in zip(missing, results):
+            self.tracker_cache[torrent.hash] = (signature, [i.url for i in trackers])
+        if missing:
+            log.debug(f"Fetched trackers for {len(missing)} torrents")
+
+    def prune_tracker_cache(self):
+        """drops cached trackers for torrents that are no longer in the client"""
+        for hash_ in set(self.tracker_cache) - set(self.torrent_store.torrents):
+            del self.tracker_cache[hash_]
 
     def match_torrent_trackers(self, torrent):
         """matches torrent tracker to trackers in config
         Args:
-            torrent: qbittorrentapi torrent obj
+            torrent: TorrentRecord obj
         Returns:
             key of shareLimit group or False
         """
-        urls = [i.url for i in torrent.trackers]
-        for key, val in self.config["shareLimits"].items():
-            if self.check_if_string_contains_any_match_term(
-                val["trackers"], " ".join(urls)
-            ):
-                return key
-        return False
+        urls = self.get_tracker_urls(torrent)
+        return self.matcher.match_trackers(" ".join(urls))
 
     def match_torrent_category(self, torrent):
         """matches torrent category to categories in config
         Args:
-            torrent: qbittorrentapi torrent obj
+            torrent: TorrentRecord obj
         Returns:
             key of shareLimit group or False
         """
-        for key, val in self.config["shareLimits"].items():
-            if torrent.category in val["categories"]:
-                return key
-        return False
+        return self.matcher.match_category(torrent.category)
 
     def assign_torrents(self):
-        """assigns torrents to share limits
+        """assigns untagged downloads to share limits, a page of the torrent store at a time with the trackers of
+        each page fetched together
         Args: None
         Returns:
-            list of dicts representing each torrent
+            dict of shareLimit group -> list of TorrentRecord objs
         """
-        assigned_torrents = []
-        downloading_torrents = self.qbitclient.torrents_info(
-            status_filter="downloading"
-        )
-        for torrent in downloading_torrents:
-            if torrent.tags != "":
-                continue
-            tracker_match = self.match_torrent_trackers(torrent)
-            category_match = self.match_torrent_category(torrent)
-            if tracker_match:
-                assigned_torrents.append(
-                    {"group": tracker_match, "name": torrent.name, "hash": torrent.hash}
-                )
-            elif category_match:
-                assigned_torrents.append(
-                    {
-                        "group": category_match,
-                        "name": torrent.name,
-                        "hash": torrent.hash,
-                    }
+        assigned_torrents = {}
+        for page in self.torrent_store.torrent_pages(status_filter="downloading"):
+            untagged_torrents = [i for i in page if not i.tags]
+            self.prefetch_trackers(untagged_torrents)
+            for torrent in untagged_torrents:
+                group = (
+                    self.match_torrent_trackers(torrent)
+                    or self.match_torrent_category(torrent)
+                    or "default"
                 )
-            else:
-                assigned_torrents.append(
-                    {"group": "default", "name": torrent.name, "hash": torrent.hash}
+                assigned_torrents.setdefault(group, []).append(torrent)
+                TORRENTS_CLASSIFIED.inc(
+                    instance=self.config.get("name", "default"), group=group
                 )
+        self.prune_tracker_cache()
         return assigned_torrents
 
     def assign_limit_groups(self):
@@ -122,26 +334,64 @@ class ShareLimiter:
         Returns:
             list of LimitGroup objects
         """
-        assigned_torrents = self.assign_torrents()
-        groups = {i["group"] for i in assigned_torrents}
-        group_list = [
-            {
-                "group": group,
-                "hashes": [i["hash"] for i in assigned_torrents if i["group"] == group],
-                "names": [i["name"] for i in assigned_torrents if i["group"] == group],
-            }
-            for group in groups
+        return [
+            LimitGroup(
+                self.config,
+                group,
+                torrents,
+                manage_upload_limit=self.allocator is None,
+            )
+            for group, torrents in self.assign_torrents().items()
         ]
-        return [LimitGroup(self.config, self.qbitclient, **i) for i in group_list]
 
     def set_limits(self):
-        """creates LimitGroup objects and sets limits
+        """sets limits for new downloads, then rebalances upload limits if the allocator is enabled
         Args: None
         Returns: None
         """
         limit_groups = self.assign_limit_groups()
-        if not limit_groups:
+        if limit_groups:
+            self.set_group_limits(limit_groups)
+        else:
             log.debug("No downloads to set limits")
-            return
+        if self.allocator:
+            self.allocator.allocate()
+        if self.queue_optimizer:
+            self.queue_optimizer.optimize()
+
+    def set_group_limits(self, limit_groups):
+        """sets the limits torrents are missing
+        torrents needing the same change share one request, across groups too. the requests are independent so they
+        run concurrently in asyncMode, while moves to the top of the queue stay in group order
+        Args:
+            limit_groups: list of LimitGroup objs
+        Returns: None
+        """
+        requests = {}
+        changed = set()
+        for limit_group in limit_groups:
+            for method, args, hash_ in limit_group.changes():
+                requests.setdefault((method, args), []).append(hash_)
+                changed.add(limit_group.group)
+        self.api.gather(
+            [
+                (method, args, {"torrent_hashes": hashes})
+                for (method, args), hashes in requests.items()
+            ]
+        )
+        calls = len(requests)
         for limit_group in limit_groups:
-            limit_group.set_group_limits()
+            if limit_group.group in changed:
+                log.info(f"Limit set to {limit_group.group} for {limit_group.names}")
+            if limit_group.priority_in_queue and not self.queue_optimizer:
+                self.qbitclient.torrents_top_priority(torrent_hashes=limit_group.hashes)
+                calls += 1
+                log.info(
+                    f"Moved priority torrents to top of queue: {limit_group.names}"
+                )
+        # every group used to send share limits, upload limit and tags
+        saved = (3 if self.allocator is None else 2) * len(limit_groups) - len(requests)
+        self.calls_saved += saved
+        log.info(
+            f"Set limits with {calls} API calls, {saved} skipped as unchanged or merged"
+        )
@@ -0,0 +1,110 @@
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class ShareMatcher:
+    """
+    shareLimits groups from config compiled once for classifying torrents
+    tracker terms of all groups go into a single Aho-Corasick automaton so a torrent is matched in one pass over
+    its tracker urls, and categories are looked up in a dict. Earlier groups in config win as before.
+    """
+
+    def __init__(self, share_groups):
+        """
+        Args:
+            share_groups: dict of group name -> ShareGroup record, as in Config.share_groups
+        """
+        self.groups = list(share_groups)
+        self.no_match = len(self.groups)  # rank used when no group matches
+        self.category_groups = {}
+        self.tag_ranks = {}  # tag -> rank of the first group that adds it
+        terms = {}
+        for rank, (group, val) in enumerate(share_groups.items()):
+            for category in val.categories:
+                self.category_groups.setdefault(category, group)
+            for tag in val.tag_names:
+                self.tag_ranks.setdefault(tag, rank)
+            for term in val.trackers:
+                terms.setdefault(term.lower(), rank)
+        self._goto, self._fail, self._rank = self.build_automaton(terms, self.no_match)
+        log.debug(
+            f"Compiled {len(terms)} tracker terms and {len(self.category_groups)} categories "
+            f"for {len(self.groups)} share limit groups"
+        )
+
+    @staticmethod
+    def build_automaton(terms, no_match):
+        """builds an Aho-Corasick automaton over the match terms
+        Args:
+            terms: dict of lowercase match term -> rank of the group it belongs to
+            no_match: rank of states that complete no term
+        Returns:
+            tuple of (goto list of dicts, fail list, rank list) indexed by state.
+            rank holds the best group rank of any term ending at that state, including terms that are suffixes of it
+        """
+        goto = [{}]
+        rank = [no_match]
+        for term, term_rank in terms.items():
+            state = 0
+            for char in term:
+                if char not in goto[state]:
+                    goto.append({})
+                    rank.append(no_match)
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            rank[state] = min(rank[state], term_rank)
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(char, 0)
+                rank[next_state] = min(rank[next_state], rank[fail[next_state]])
+        return goto, fail, rank
+
+    def match_trackers(self, string_):
+        """finds the highest precedence group with a tracker term contained in a string
+        Args:
+            string_: tracker urls joined into one string
+        Returns:
+            key of shareLimit group or False
+        """
+        goto, fail, rank = self._goto, self._fail, self._rank
+        best = rank[0]
+        state = 0
+        for char in string_.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if rank[state] < best:
+                best = rank[state]
+        return self.groups[best] if best < self.no_match else False
+
+    def match_category(self, category):
+        """finds the first group that lists a category
+        Args:
+            category: torrent category
+        Returns:
+            key of shareLimit group or False
+        """
+        return self.category_groups.get(category, False)
+
+    def match_tags(self, tags):
+        """finds the highest precedence group whose tags a torrent has, so a torrent tagged for several groups
+        belongs to the same group it was assigned to
+        Args:
+            tags: collection of the torrent's tag names
+        Returns:
+            key of shareLimit group or False
+        """
+        best = min(
+            (self.tag_ranks[tag] for tag in tags if tag in self.tag_ranks),
+            default=self.no_match,
+        )
+        return self.groups[best] if best < self.no_match else False
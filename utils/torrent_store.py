@@ -0,0 +1,279 @@
+import logging
+from functools import lru_cache
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+# torrent states covered by each of qbittorrent's list filters
+DOWNLOADING_STATES = frozenset(
+    {
+        "allocating",
+        "downloading",
+        "metaDL",
+        "forcedMetaDL",
+        "pausedDL",
+        "stoppedDL",
+        "queuedDL",
+        "stalledDL",
+        "checkingDL",
+        "forcedDL",
+    }
+)
+SEEDING_STATES = frozenset(
+    {"uploading", "stalledUP", "checkingUP", "queuedUP", "forcedUP"}
+)
+COMPLETED_STATES = SEEDING_STATES | {"pausedUP", "stoppedUP"}
+STATUS_FILTERS = {
+    "downloading": DOWNLOADING_STATES,
+    "seeding": SEEDING_STATES,
+    "completed": COMPLETED_STATES,
+}
+# torrents per page of a paged listing and the field pages are ordered by, for listPageSize and listSortKey
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_SORT = "added_on"
+
+
+def paged_torrents_info(
+    qbitclient, status_filter=None, page_size=DEFAULT_PAGE_SIZE, sort=DEFAULT_SORT
+):
+    """lists torrents from the API a page at a time with limit and offset, so a sweep starts on the first page
+    without holding every torrent. pages are ordered by sort, a field that does not change such as added_on keeps
+    them from shifting: a torrent added during the sweep lands on the last page and one removed makes the sweep
+    miss at most the torrent that takes its place, which the next sweep picks up. torrents already on the previous
+    page are skipped
+    Args:
+        qbitclient: qbittorrentapi client
+        status_filter: status filter for torrents_info, None for all torrents
+        page_size: torrents per request, 0 for all of them in one
+        sort: torrent field pages are ordered by
+    Yields:
+        lists of torrent objs from qbittorrentapi
+    """
+    offset = 0
+    previous = set()
+    while True:
+        page = qbitclient.torrents_info(
+            status_filter=status_filter, sort=sort, limit=page_size, offset=offset
+        )
+        fresh = [i for i in page if i.hash not in previous]
+        if fresh:
+            yield fresh
+        if not page_size or len(page) < page_size:
+            return
+        offset += len(page)
+        previous = {i.hash for i in page}
+
+
+@lru_cache(maxsize=4096)
+def parse_tags(tags):
+    """splits qbittorrent's comma separated tags into a frozenset of tag names
+    memoized, so torrents with the same tags share one frozenset
+    """
+    return frozenset(i.strip() for i in tags.split(",") if i.strip())
+
+
+class TorrentRecord:
+    """
+    the fields of a torrent listing that qbitmgr uses, about a fifth of what qbittorrent sends.
+    read like a qbittorrentapi torrent obj through attributes or get(). tags are a frozenset.
+    records are replaced, not changed, when a sync changes a torrent, so a listing stays as it was when it was made
+    """
+
+    __slots__ = (
+        "hash",
+        "name",
+        "category",
+        "tags",
+        "save_path",
+        "content_path",
+        "state",
+        "added_on",
+        "completion_on",
+        "ratio",
+        "ratio_limit",
+        "seeding_time",
+        "seeding_time_limit",
+        "up_limit",
+        "upspeed",
+        "num_leechs",
+        "num_incomplete",
+        "num_complete",
+        "priority",
+        "tracker",
+        "trackers_count",
+    )
+
+    def __init__(self, hash_):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        self.hash = hash_
+        self.tags = frozenset()
+
+    def updated(self, fields):
+        """copies the record with fields from a sync/maindata delta applied, fields it does not hold are dropped
+        Args:
+            fields: dict of changed torrent fields
+        Returns:
+            TorrentRecord obj
+        """
+        # one assignment per field, a loop over __slots__ with setattr takes several times as long at 100k torrents
+        get = fields.get
+        record = TorrentRecord.__new__(TorrentRecord)
+        record.hash = self.hash
+        record.name = get("name", self.name)
+        record.category = get("category", self.category)
+        record.tags = parse_tags(fields["tags"]) if "tags" in fields else self.tags
+        record.save_path = get("save_path", self.save_path)
+        record.content_path = get("content_path", self.content_path)
+        record.state = get("state", self.state)
+        record.added_on = get("added_on", self.added_on)
+        record.completion_on = get("completion_on", self.completion_on)
+        record.ratio = get("ratio", self.ratio)
+        record.ratio_limit = get("ratio_limit", self.ratio_limit)
+        record.seeding_time = get("seeding_time", self.seeding_time)
+        record.seeding_time_limit = get("seeding_time_limit", self.seeding_time_limit)
+        record.up_limit = get("up_limit", self.up_limit)
+        record.upspeed = get("upspeed", self.upspeed)
+        record.num_leechs = get("num_leechs", self.num_leechs)
+        record.num_incomplete = get("num_incomplete", self.num_incomplete)
+        record.num_complete = get("num_complete", self.num_complete)
+        record.priority = get("priority", self.priority)
+        record.tracker = get("tracker", self.tracker)
+        record.trackers_count = get("trackers_count", self.trackers_count)
+        return record
+
+    def get(self, name, default=None):
+        """a field, or default if qbittorrent has not sent it"""
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def __repr__(self):
+        return f"TorrentRecord({self.hash!r}, {self.name!r}, {self.state!r})"
+
+
+# copied for torrents new to the store, so fields qbittorrent has not sent read as None
+BLANK_RECORD = TorrentRecord(None)
+
+
+class TorrentStore:
+    """
+    in-memory copy of the torrent list in qbittorrent, one TorrentRecord per torrent keyed by hash
+    kept current with the rid based deltas from sync/maindata so a refresh only transfers what changed
+    """
+
+    def __init__(self, qbitclient, page_size=DEFAULT_PAGE_SIZE, sort=DEFAULT_SORT):
+        self.qbitclient = qbitclient
+        self.page_size = page_size
+        self.sort = sort
+        self.rid = 0
+        self.generation = 0  # local sync counter, unlike rid it never goes back when qbittorrent restarts
+        self.changed = (
+            {}
+        )  # hash -> generation of the sync that last changed the torrent
+        self.torrents = {}
+        self.categories = {}
+        self.tags = set()
+        self._lock = Lock()
+
+    def sync(self):
+        """requests changes since the last sync and applies them to the store
+        Args: None
+        Returns: None
+        """
+        with self._lock:
+            maindata = self.qbitclient.sync_maindata(rid=self.rid)
+            self.generation += 1
+            if maindata.get("full_update"):
+                self.torrents = {}
+                self.changed = {}
+                self.categories = {}
+                self.tags = set()
+            for hash_, fields in maindata.get("torrents", {}).items():
+                record = self.torrents.get(hash_, BLANK_RECORD).updated(fields)
+                record.hash = hash_
+                self.torrents[hash_] = record
+                self.changed[hash_] = self.generation
+            for hash_ in maindata.get("torrents_removed", []):
+                self.torrents.pop(hash_, None)
+                self.changed.pop(hash_, None)
+            for name, fields in maindata.get("categories", {}).items():
+                self.categories.setdefault(name, {}).update(fields)
+            for name in maindata.get("categories_removed", []):
+                self.categories.pop(name, None)
+            self.tags.update(maindata.get("tags", []))
+            self.tags.difference_update(maindata.get("tags_removed", []))
+            log.debug(
+                f"Synced rid {self.rid} -> {maindata['rid']}: {len(maindata.get('torrents', {}))} torrents changed, "
+                f"{len(self.torrents)} total"
+            )
+            self.rid = maindata["rid"]
+
+    def changed_since(self, generation):
+        """gets torrents added or changed by syncs after the given one
+        Args:
+            generation: value of self.generation when the caller last looked
+        Returns:
+            tuple of (set of hashes, current generation)
+        """
+        with self._lock:
+            return (
+                {i for i, changed in self.changed.items() if changed > generation},
+                self.generation,
+            )
+
+    def torrents_info(self, status_filter=None, torrent_hashes=None):
+        """lists torrents in the store, mirroring qbitclient.torrents_info
+        Args:
+            status_filter: 'downloading', 'seeding', 'completed' or None for all torrents
+            torrent_hashes: iterable of hashes to limit the listing to, None for all torrents
+        Returns:
+            list of TorrentRecord objs
+        """
+        states = STATUS_FILTERS[status_filter] if status_filter else None
+        with self._lock:
+            if torrent_hashes is None:
+                torrents = self.torrents.values()
+            else:
+                torrents = [
+                    self.torrents[i] for i in torrent_hashes if i in self.torrents
+                ]
+            if states is None:
+                return list(torrents)
+            return [torrent for torrent in torrents if torrent.state in states]
+
+    def torrent_pages(self, status_filter=None, torrent_hashes=None):
+        """lists torrents in the store a page of page_size at a time, ordered by the sort field.
+        only the hashes are taken up front, the lock is held for one page at a time so syncs are not held up by a
+        sweep, and a torrent a sync changes before its page is reached is listed as it is then
+        Args:
+            status_filter: 'downloading', 'seeding', 'completed' or None for all torrents
+            torrent_hashes: iterable of hashes to limit the listing to, None for all torrents
+        Yields:
+            lists of TorrentRecord objs
+        """
+        states = STATUS_FILTERS[status_filter] if status_filter else None
+        with self._lock:
+            torrents = self.torrents
+            if torrent_hashes is None:
+                hashes = list(torrents)
+            else:
+                hashes = [i for i in torrent_hashes if i in torrents]
+            if self.sort:
+                hashes.sort(key=lambda i: torrents[i].get(self.sort, 0))
+        page_size = self.page_size or len(hashes) or 1
+        for start in range(0, len(hashes), page_size):
+            with self._lock:
+                page = [
+                    self.torrents[i]
+                    for i in hashes[start : start + page_size]
+                    if i in self.torrents
+                ]
+            if states is not None:
+                page = [torrent for torrent in page if torrent.state in states]
+            if page:
+                yield page
+
+    def iter_torrents(self, status_filter=None, torrent_hashes=None):
+        """torrent_pages, one TorrentRecord obj at a time"""
+        for page in self.torrent_pages(status_filter, torrent_hashes):
+            yield from page
@@ -0,0 +1,138 @@
+import hashlib
+import logging
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.async_client import SerialClient
+
+log = logging.getLogger(__name__)
+
+
+class PieceVerifier:
+    """
+    checks files copied out of a torrent against the torrent's own v1 piece hashes
+    only pieces covering copied files are hashed, in parallel over memory mapped reads
+    """
+
+    def __init__(self, qbitclient, torrent_hash, workers=4, api=None):
+        self.qbitclient = qbitclient
+        self.api = api or SerialClient(qbitclient)
+        self.torrent_hash = torrent_hash
+        self.workers = max(1, workers)
+        self.piece_size = 0
+        self.piece_hashes = []
+        self.files = []  # [name, offset, size, piece_range] in torrent order
+
+    def load(self):
+        """fetches piece size, piece hashes and the file layout from qbittorrent
+        Returns:
+            False if the torrent has no v1 piece hashes to verify against
+        """
+        properties, piece_hashes, files = self.api.gather(
+            [
+                (method, (), {"torrent_hash": self.torrent_hash})
+                for method in (
+                    "torrents_properties",
+                    "torrents_piece_hashes",
+                    "torrents_files",
+                )
+            ]
+        )
+        self.piece_size = properties["piece_size"]
+        self.piece_hashes = list(piece_hashes)
+        offset = 0
+        aligned = False
+        for file in files:
+            first_piece = file["piece_range"][0]
+            # pad files are hidden from the list, so padded torrents start each file on a piece boundary
+            if file["size"] and first_piece != offset // self.piece_size:
+                aligned = True
+            self.files.append([file["name"], offset, file["size"], file["piece_range"]])
+            offset += file["size"]
+        if aligned:
+            for file in self.files:
+                file[1] = file[3][0] * self.piece_size
+        return bool(self.piece_hashes) and all(len(i) == 40 for i in self.piece_hashes)
+
+    def pieces_to_verify(self, destinations):
+        """maps every piece that is fully covered by copied files to the file segments it is made of
+        Args:
+            destinations: dict of torrent file name -> path of its copy
+        Returns:
+            dict of piece index -> list of (destination path, start, end)
+        """
+        pieces = {}
+        for name, offset, size, (first, last) in self.files:
+            if not size or name not in destinations:
+                continue
+            for piece in range(first, last + 1):
+                pieces.setdefault(piece, None)
+        total_size = max(offset + size for _, offset, size, _ in self.files)
+        for piece in list(pieces):
+            start = piece * self.piece_size
+            end = min(start + self.piece_size, total_size)
+            segments = []
+            for name, offset, size, _ in self.files:
+                if not size or offset >= end or offset + size <= start:
+                    continue
+                if name not in destinations:
+                    segments = None  # piece shares data with a file that was not copied
+                    break
+                segments.append(
+                    (
+                        destinations[name],
+                        max(start, offset) - offset,
+                        min(end, offset + size) - offset,
+                    )
+                )
+            if segments:
+                pieces[piece] = segments
+            else:
+                del pieces[piece]
+        return pieces
+
+    def verify(self, destinations):
+        """verifies copies of torrent files
+        Args:
+            destinations: dict of torrent file name -> path of its copy
+        Returns:
+            set of torrent file names whose copies are truncated or do not match their pieces
+        """
+        sizes = {name: size for name, _, size, _ in self.files}
+        failed = {
+            name
+            for name, path in destinations.items()
+            if name in sizes and os.path.getsize(path) != sizes[name]
+        }
+        checked = {
+            name: path for name, path in destinations.items() if name not in failed
+        }
+        pieces = self.pieces_to_verify(checked)
+        maps = {}
+        try:
+            for path in {s[0] for segments in pieces.values() for s in segments}:
+                with open(path, "rb") as file:
+                    maps[path] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            def check_piece(piece):
+                sha1 = hashlib.sha1()
+                for path, start, end in pieces[piece]:
+                    with memoryview(maps[path]) as view:
+                        sha1.update(view[start:end])
+                return piece, sha1.hexdigest() == self.piece_hashes[piece]
+
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                bad_pieces = [
+                    piece for piece, ok in pool.map(check_piece, pieces) if not ok
+                ]
+        finally:
+            for mapped in maps.values():
+                mapped.close()
+        paths = {path: name for name, path in checked.items()}
+        for piece in bad_pieces:
+            failed.update(paths[path] for path, _, _ in pieces[piece])
+        log.debug(
+            f"Verified {len(pieces)} pieces of {self.torrent_hash}: {len(bad_pieces)} bad"
+        )
+        return failed